@@ -0,0 +1,184 @@
+import time
+from datetime import datetime
+
+import numpy as np
+
+from database import transaction
+from fetcher import get_default_fetcher
+from sql_queries import UPSERT_PRICE_SERIES
+
+INTERVALS = {'hourly': 3600, 'daily': 86400}
+# Look this far before the range start so the first grid point has a price to carry forward
+PRICE_LOOKBACK = 2 * 86400
+# Uncovered stretches shorter than this (e.g. the minutes since the last fetch) are not downloaded
+MIN_GAP = 3600
+
+
+def _to_unix(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S" if len(value) > 10 else "%Y-%m-%d")
+    return int(value.timestamp())
+
+
+class PortfolioBackfill:
+    """
+    Rebuilds a portfolio's value over time from its transactions and cached historical prices.
+
+    Price series come from /coins/{id}/market_chart/range and are cached in price_series as
+    packed arrays, so only the uncovered part of a requested range is ever downloaded and a
+    cached series loads without building a Python object per point.
+    """
+
+    def __init__(self, conn, fetcher=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.fetcher = fetcher or get_default_fetcher()
+
+    def ensure_prices(self, coin_ids, vs_currency, start_ts, end_ts):
+        """
+        Download and cache whatever part of [start_ts, end_ts] is not cached yet for each coin.
+
+        Returns the coin ids that could not be fetched.
+        """
+        end_ts = min(end_ts, int(time.time()))
+        self.cursor.execute('''SELECT coin_id, start_ts, end_ts FROM price_series WHERE vs_currency = ?''',
+                            (vs_currency,))
+        coverage = {coin_id: (covered_start, covered_end) for coin_id, covered_start, covered_end in self.cursor}
+
+        gaps = []
+        for coin_id in coin_ids:
+            if coin_id not in coverage:
+                gaps.append((coin_id, start_ts - PRICE_LOOKBACK, end_ts))
+                continue
+            covered_start, covered_end = coverage[coin_id]
+            if covered_start - start_ts > MIN_GAP:
+                gaps.append((coin_id, start_ts - PRICE_LOOKBACK, covered_start))
+            if end_ts - covered_end > MIN_GAP:
+                gaps.append((coin_id, covered_end, end_ts))
+
+        def fetch_gap(gap):
+            coin_id, gap_start, gap_end = gap
+            params = {'vs_currency': vs_currency, 'from': gap_start, 'to': gap_end}
+            return self.fetcher.get_json(f"coins/{coin_id}/market_chart/range", params)
+
+        charts = self.fetcher.map(fetch_gap, gaps)
+        failed = set()
+        with transaction(self.conn):
+            for (coin_id, gap_start, gap_end), chart in zip(gaps, charts):
+                if chart is None:
+                    failed.add(coin_id)
+                    continue
+                points = np.array([point for point in chart.get('prices', []) if point[1] is not None],
+                                  dtype=np.float64).reshape(-1, 2)
+                self._merge_series(coin_id, vs_currency, gap_start, gap_end,
+                                   (points[:, 0] // 1000).astype(np.int64), points[:, 1])
+        return failed
+
+    def _merge_series(self, coin_id, vs_currency, start_ts, end_ts, timestamps, prices):
+        self.cursor.execute('''SELECT start_ts, end_ts, timestamps, prices FROM price_series
+                               WHERE coin_id = ? AND vs_currency = ?''', (coin_id, vs_currency))
+        existing = self.cursor.fetchone()
+        if existing:
+            start_ts, end_ts = min(start_ts, existing[0]), max(end_ts, existing[1])
+            timestamps = np.concatenate((np.frombuffer(existing[2], dtype='<i8'), timestamps))
+            prices = np.concatenate((np.frombuffer(existing[3], dtype='<f8'), prices))
+        # np.unique sorts; keep the newest price for a duplicated timestamp
+        order = np.argsort(timestamps, kind='stable')[::-1]
+        unique_timestamps, first = np.unique(timestamps[order], return_index=True)
+        unique_prices = prices[order][first]
+        self.cursor.execute(UPSERT_PRICE_SERIES, (
+            coin_id, vs_currency, int(start_ts), int(end_ts),
+            unique_timestamps.astype('<i8').tobytes(), unique_prices.astype('<f8').tobytes()))
+
+    def load_prices(self, coin_ids, vs_currency, start_ts, end_ts):
+        """
+        Return {coin_id: (timestamps, prices)} as NumPy arrays sorted by time.
+        """
+        wanted = set(coin_ids)
+        series = {coin_id: (np.empty(0), np.empty(0)) for coin_id in coin_ids}
+        self.cursor.execute('''SELECT coin_id, timestamps, prices FROM price_series WHERE vs_currency = ?''',
+                            (vs_currency,))
+        for coin_id, timestamps_blob, prices_blob in self.cursor:
+            if coin_id not in wanted:
+                continue
+            timestamps = np.frombuffer(timestamps_blob, dtype='<i8').astype(np.float64)
+            prices = np.frombuffer(prices_blob, dtype='<f8')
+            first, last = np.searchsorted(timestamps, [start_ts - PRICE_LOOKBACK, end_ts], side='right')
+            series[coin_id] = (timestamps[max(first - 1, 0):last], prices[max(first - 1, 0):last])
+        return series
+
+    def load_transactions(self, portfolio_id):
+        """
+        Return {coin_id: (timestamps, amounts)} for a portfolio's ledger, sorted by time.
+        """
+        self.cursor.execute('''SELECT coin_id, date, amount FROM transactions
+                               WHERE portfolio_id = ? ORDER BY coin_id, date''', (portfolio_id,))
+        rows = self.cursor.fetchall()
+        if not rows:
+            return {}
+        coin_ids = np.array([row[0] for row in rows])
+        # Dates are stored as local "YYYY-MM-DD HH:MM:SS"; shift to UTC with the current offset
+        dates = np.array([row[1].replace(' ', 'T') for row in rows], dtype='datetime64[s]')
+        utc_offset = datetime.now().astimezone().utcoffset().total_seconds()
+        timestamps = dates.astype(np.int64).astype(np.float64) - utc_offset
+        amounts = np.array([row[2] for row in rows], dtype=np.float64)
+
+        ledger = {}
+        boundaries = np.flatnonzero(coin_ids[1:] != coin_ids[:-1]) + 1
+        for segment in np.split(np.arange(len(rows)), boundaries):
+            ledger[str(coin_ids[segment[0]])] = (timestamps[segment], amounts[segment])
+        return ledger
+
+    def value_curve(self, portfolio_id, vs_currency, start=None, end=None, interval='daily', fetch=True):
+        """
+        Compute the portfolio value at every interval step between `start` and `end`.
+
+        Returns {'timestamps': ndarray, 'values': ndarray, 'coins': [...], 'holdings': ndarray,
+        'prices': ndarray, 'missing': [...]} where holdings and prices are (steps x coins) matrices.
+        """
+        if interval not in INTERVALS:
+            raise ValueError(f"Unknown interval '{interval}'")
+        step = INTERVALS[interval]
+        ledger = self.load_transactions(portfolio_id)
+        coin_ids = sorted(ledger)
+        end_ts = _to_unix(end) or int(time.time())
+        start_ts = _to_unix(start)
+        if start_ts is None:
+            start_ts = int(min(timestamps[0] for timestamps, _ in ledger.values())) if ledger else end_ts
+        start_ts -= start_ts % step
+
+        missing = set()
+        if fetch and coin_ids:
+            missing = self.ensure_prices(coin_ids, vs_currency, start_ts, end_ts)
+        series = self.load_prices(coin_ids, vs_currency, start_ts, end_ts)
+
+        grid = np.arange(start_ts, end_ts + 1, step, dtype=np.float64)
+        holdings = np.zeros((len(grid), len(coin_ids)))
+        prices = np.full((len(grid), len(coin_ids)), np.nan)
+        for column, coin_id in enumerate(coin_ids):
+            tx_times, tx_amounts = ledger[coin_id]
+            positions = np.searchsorted(tx_times, grid, side='right')
+            cumulative = np.concatenate(([0.0], np.cumsum(tx_amounts)))
+            holdings[:, column] = cumulative[positions]
+
+            price_times, price_values = series[coin_id]
+            if len(price_times):
+                # Carry the last known price forward onto each grid point
+                latest = np.searchsorted(price_times, grid, side='right') - 1
+                prices[:, column] = np.where(latest >= 0, price_values[np.maximum(latest, 0)], np.nan)
+            else:
+                missing.add(coin_id)
+
+        values = np.nansum(holdings * prices, axis=1)
+        return {
+            'timestamps': grid,
+            'values': values,
+            'coins': coin_ids,
+            'holdings': holdings,
+            'prices': prices,
+            'missing': sorted(missing),
+        }
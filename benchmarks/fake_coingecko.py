@@ -0,0 +1,223 @@
+"""
+Local stand-in for the CoinGecko API, for benchmarking without a network.
+
+    python -m benchmarks.fake_coingecko --port 8900 --latency 0.05 --throttle-every 20
+    COINGECKO_API_URL=http://127.0.0.1:8900 python portfolio.py refresh
+
+Serves /coins/list, /coins/markets, /simple/price, /coins/{id} and
+/coins/{id}/market_chart/range for the coins of benchmarks.generate, with deterministic prices.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.generate import base_price, synthetic_coins
+
+CHANGE_WINDOWS = ('1h', '24h', '7d', '14d', '30d', '200d', '1y')
+
+
+class FakeCoinGeckoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, keep-alive clients stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        server.delay()
+        if server.throttle():
+            self.send_json({'status': {'error_code': 429, 'error_message': "You've exceeded the Rate Limit."}},
+                           HTTPStatus.TOO_MANY_REQUESTS, {'Retry-After': f'{server.retry_after:g}'})
+            return
+
+        parts = url.path.strip('/').split('/')
+        if parts == ['coins', 'list']:
+            self.send_coin_list()
+        elif parts == ['coins', 'markets']:
+            self.send_json(self.markets(query))
+        elif parts == ['simple', 'price']:
+            self.send_json(self.simple_price(query))
+        elif len(parts) == 2 and parts[0] == 'coins' and parts[1] in server.coin_ids:
+            self.send_json(self.coin(parts[1]))
+        elif len(parts) == 4 and parts[0] == 'coins' and parts[2:] == ['market_chart', 'range']:
+            self.send_json(self.market_chart(parts[1], query))
+        else:
+            self.send_json({'error': 'Not Found'}, HTTPStatus.NOT_FOUND)
+
+    def markets(self, query):
+        vs_currency = query.get('vs_currency', 'usd')
+        rows = []
+        for coin_id in query.get('ids', '').split(','):
+            if coin_id in self.server.coin_ids:
+                symbol, name = self.server.coin_ids[coin_id]
+                row = {'id': coin_id, 'symbol': symbol, 'name': name,
+                       'current_price': self.server.price(coin_id, vs_currency)}
+                for window in CHANGE_WINDOWS:
+                    row[f'price_change_percentage_{window}_in_currency'] = self.server.change(coin_id, window)
+                rows.append(row)
+        return rows
+
+    def simple_price(self, query):
+        currencies = query.get('vs_currencies', 'usd').split(',')
+        prices = {}
+        for coin_id in query.get('ids', '').split(','):
+            if coin_id in self.server.coin_ids:
+                quotes = prices[coin_id] = {}
+                for vs_currency in currencies:
+                    quotes[vs_currency] = self.server.price(coin_id, vs_currency)
+                    quotes[f'{vs_currency}_24h_change'] = self.server.change(coin_id, '24h')
+        return prices
+
+    def coin(self, coin_id):
+        symbol, name = self.server.coin_ids[coin_id]
+        currencies = ('usd', 'eur', 'btc')
+        market_data = {'current_price': {vs_currency: self.server.price(coin_id, vs_currency)
+                                         for vs_currency in currencies}}
+        for window in CHANGE_WINDOWS + ('60d',):
+            market_data[f'price_change_percentage_{window}_in_currency'] = {
+                vs_currency: self.server.change(coin_id, window) for vs_currency in currencies}
+        return {'id': coin_id, 'symbol': symbol, 'name': name, 'market_data': market_data}
+
+    def market_chart(self, coin_id, query):
+        start, end = int(float(query.get('from', 0))), int(float(query.get('to', 0)))
+        price = self.server.price(coin_id, query.get('vs_currency', 'usd'))
+        # Hourly points, like CoinGecko returns for ranges up to 90 days
+        return {'prices': [[ts * 1000, price * (1 + 0.1 * ((ts // 3600) % 24 - 12) / 12)]
+                           for ts in range(start - start % 3600, end + 1, 3600)]}
+
+    def send_coin_list(self):
+        body, etag = self.server.coin_list_body()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(None, body=body, extra_headers={'ETag': etag})
+
+    def send_json(self, payload, status=HTTPStatus.OK, extra_headers=None, body=None):
+        if body is None:
+            body = json.dumps(payload, separators=(',', ':')).encode()
+        headers = dict(extra_headers or {})
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) >= 1024:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeCoinGeckoServer(ThreadingHTTPServer):
+    """
+    Fake API for the synthetic coins, with optional latency and rate limiting.
+
+    Every request waits `latency` plus up to `jitter` seconds. With `throttle_every` N, every Nth
+    request gets a 429 with Retry-After `retry_after`. Counters of requests and 429s are kept for reports.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, coins=2000, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, throttle_every=0,
+                 retry_after=1.0, seed=0, verbose=False):
+        self.coin_ids = {coin_id: (symbol, name) for coin_id, symbol, name in synthetic_coins(coins)}
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self._coin_list = None
+        super().__init__((host, port), FakeCoinGeckoHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def throttle(self):
+        with self.lock:
+            self.requests += 1
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+        return False
+
+    def counters(self):
+        with self.lock:
+            return {'requests': self.requests, 'throttled': self.throttled}
+
+    def coin_list_body(self):
+        with self.lock:
+            if self._coin_list is None:
+                body = json.dumps([{'id': coin_id, 'symbol': symbol, 'name': name}
+                                   for coin_id, (symbol, name) in self.coin_ids.items()]).encode()
+                self._coin_list = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+            return self._coin_list
+
+    @staticmethod
+    def price(coin_id, vs_currency):
+        return base_price(coin_id, vs_currency)
+
+    @staticmethod
+    def change(coin_id, window):
+        return (zlib.crc32(f'{coin_id}:{window}'.encode()) % 2000) / 100 - 10
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-coingecko', daemon=True)
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a fake CoinGecko API for benchmarks.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--coins', type=int, default=2000, help="Number of synthetic coins (match the database)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many extra seconds, at random")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Answer every Nth request with 429")
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    server = FakeCoinGeckoServer(args.coins, args.host, args.port, args.latency, args.jitter,
+                                 args.throttle_every, args.retry_after, verbose=args.verbose)
+    print(f"Fake CoinGecko API at {server.url} ({len(server.coin_ids)} coins). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Build synthetic portfolio databases for the benchmarks.
+
+    python -m benchmarks.generate bench.db --scale medium
+    python -m benchmarks.generate bench.db --portfolios 3 --transactions 50000 --seed 7
+
+Amounts, prices and names are derived from the seed, so the same arguments always produce the
+same data; only the dates move, since history is laid out backwards from now.
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+from database import connect, rebuild_positions, transaction
+from history import (
+    DATE_FORMAT,
+    HISTORY_RETENTION,
+    ROLLUP_RESOLUTIONS,
+    bucket_start,
+    prune_history,
+    record_snapshot,
+)
+from prices import market_to_coin_data, store_coin_data
+from sql_queries import INSERT_TRANSACTION, UPSERT_HISTORY_ROLLUP
+
+# portfolios, listed coins, coins held per portfolio, transactions and history snapshots per portfolio
+SCALES = {
+    'small': {'portfolios': 2, 'coins': 2000, 'holdings': 20, 'transactions': 1000, 'history': 2000},
+    'medium': {'portfolios': 5, 'coins': 15000, 'holdings': 100, 'transactions': 20000, 'history': 20000},
+    'large': {'portfolios': 10, 'coins': 15000, 'holdings': 500, 'transactions': 200000, 'history': 100000},
+}
+PORTFOLIO_CURRENCIES = ('usd', 'eur', 'btc')
+# Seconds between history snapshots, i.e. the refresh interval being simulated
+HISTORY_INTERVAL = 300
+WORDS = ('bit', 'coin', 'chain', 'swap', 'dao', 'meta', 'moon', 'safe', 'doge', 'inu', 'fi', 'net',
+         'protocol', 'token', 'verse', 'wrapped', 'staked', 'layer', 'zero', 'nova')
+
+
+def synthetic_coins(count):
+    """
+    Return [(coin_id, symbol, name)] with realistic-looking, overlapping names.
+    """
+    rng = random.Random(count)
+    coins = []
+    for index in range(count):
+        words = [WORDS[rng.randrange(len(WORDS))] for _ in range(rng.randint(1, 3))]
+        name = ' '.join(word.capitalize() for word in words) + f' {index}'
+        symbol = ''.join(word[0] for word in words) + str(index % 1000)
+        coins.append((f"{'-'.join(words)}-{index}", symbol, name))
+    return coins
+
+
+def base_price(coin_id, vs_currency='usd'):
+    """
+    Deterministic price for a coin, shared with the fake CoinGecko server.
+    """
+    usd = 10 ** ((zlib.crc32(coin_id.encode()) % 1000) / 1000 * 8 - 4)
+    return usd * {'usd': 1.0, 'eur': 0.92, 'btc': 1 / 60000}.get(vs_currency, 1.0)
+
+
+def generate(path, portfolios, coins, holdings, transactions, history, seed=0, interval=HISTORY_INTERVAL):
+    """
+    Create `path` from scratch and fill it; returns the coin ids held by any portfolio.
+    """
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(seed)
+    conn = connect(path)
+    coin_list = synthetic_coins(coins)
+    now = datetime.now().replace(microsecond=0)
+    held = set()
+
+    with transaction(conn) as cursor:
+        cursor.executemany('''INSERT INTO crypto_lookup (coin_id, symbol, name) VALUES (?, ?, ?)''', coin_list)
+
+    for portfolio_id in range(1, portfolios + 1):
+        currency = PORTFOLIO_CURRENCIES[(portfolio_id - 1) % len(PORTFOLIO_CURRENCIES)]
+        portfolio_coins = [coin_id for coin_id, _, _ in rng.sample(coin_list, min(holdings, coins))]
+        held.update(portfolio_coins)
+        start = now - timedelta(days=3 * 365)
+        step = (now - start) / max(transactions, 1)
+        amounts = dict.fromkeys(portfolio_coins, 0.0)
+        rows = []
+        for index in range(transactions):
+            coin_id = rng.choice(portfolio_coins)
+            price = base_price(coin_id, currency) * rng.uniform(0.3, 1.7)
+            date = (start + step * index).strftime(DATE_FORMAT)
+            if amounts[coin_id] > 0 and rng.random() < 0.3:
+                amount = amounts[coin_id] * rng.uniform(0.1, 0.9)
+                amounts[coin_id] -= amount
+                rows.append((portfolio_id, coin_id, -amount, price, date, 'sell'))
+            else:
+                amount = rng.uniform(0.01, 100.0)
+                amounts[coin_id] += amount
+                rows.append((portfolio_id, coin_id, amount, price, date, 'buy'))
+
+        with transaction(conn) as cursor:
+            cursor.execute('''INSERT INTO portfolios (id, name, currency) VALUES (?, ?, ?)''',
+                           (portfolio_id, f'portfolio-{portfolio_id}', currency))
+            cursor.executemany(INSERT_TRANSACTION, rows)
+
+        # Snapshots older than the raw retention would be pruned down to their rollups, so only
+        # the rollups are written for them; recent ones are recorded like a live refresh would
+        first = now - timedelta(seconds=interval * history)
+        raw_cutoff = now - HISTORY_RETENTION['raw']
+        held_amounts = {coin_id: amount for coin_id, amount in amounts.items() if amount > 0}
+        base_total = sum(amount * base_price(coin_id, currency) for coin_id, amount in held_amounts.items())
+        with transaction(conn) as cursor:
+            for index in range(history):
+                ts = first + timedelta(seconds=interval * (index + 1))
+                drift = 1 + 0.2 * (index / max(history, 1))
+                if ts < raw_cutoff:
+                    value = base_total * drift * rng.uniform(0.98, 1.02)
+                    cursor.executemany(UPSERT_HISTORY_ROLLUP, [
+                        {'portfolio_id': portfolio_id, 'resolution': resolution,
+                         'bucket': bucket_start(ts.strftime(DATE_FORMAT), resolution),
+                         'ts': ts.strftime(DATE_FORMAT), 'value': value}
+                        for resolution in ROLLUP_RESOLUTIONS
+                    ])
+                    continue
+                coins_at = {coin_id: (amount, base_price(coin_id, currency) * drift * rng.uniform(0.98, 1.02))
+                            for coin_id, amount in held_amounts.items()}
+                record_snapshot(cursor, portfolio_id, ts.strftime(DATE_FORMAT), coins_at, prune=False)
+            prune_history(cursor, portfolio_id, now)
+
+    last_updated = now.strftime(DATE_FORMAT)
+    with transaction(conn) as cursor:
+        rebuild_positions(cursor)
+        for coin_id in sorted(held):
+            for vs_currency in PORTFOLIO_CURRENCIES:
+                price = base_price(coin_id, vs_currency)
+                market = {'id': coin_id, 'current_price': price, 'price_change_percentage_24h_in_currency': 1.0}
+                store_coin_data(cursor, coin_id, market_to_coin_data(market, vs_currency), last_updated)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    return sorted(held)
+
+
+def write_import_file(path, coin_ids, rows, seed=0):
+    """
+    Write a CSV exchange export with `rows` buys and sells over `coin_ids`, for the import benchmark.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    amounts = dict.fromkeys(coin_ids, 0.0)
+    with open(path, 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['timestamp', 'asset', 'side', 'quantity', 'price'])
+        for index in range(rows):
+            coin_id = rng.choice(coin_ids)
+            side = 'sell' if amounts[coin_id] > 1 and rng.random() < 0.3 else 'buy'
+            amount = amounts[coin_id] * 0.5 if side == 'sell' else rng.uniform(0.01, 100.0)
+            amounts[coin_id] += -amount if side == 'sell' else amount
+            writer.writerow([(start + timedelta(minutes=index)).strftime(DATE_FORMAT), coin_id, side,
+                             f'{amount:.8f}', f'{base_price(coin_id) * rng.uniform(0.5, 1.5):.8f}'])
+
+
+def scale_arguments(parser):
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for name in ('portfolios', 'coins', 'holdings', 'transactions', 'history'):
+        parser.add_argument(f'--{name}', type=int, help=f"Override the scale's number of {name}")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def resolve_scale(args):
+    scale = dict(SCALES[args.scale])
+    for name in scale:
+        if getattr(args, name) is not None:
+            scale[name] = getattr(args, name)
+    return scale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic portfolio database.")
+    parser.add_argument('path')
+    scale_arguments(parser)
+    args = parser.parse_args(argv)
+    scale = resolve_scale(args)
+    started = datetime.now()
+    generate(args.path, seed=args.seed, **scale)
+    print(f"Generated {args.path} ({', '.join(f'{name}={value}' for name, value in scale.items())}) "
+          f"in {(datetime.now() - started).total_seconds():.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+"""
+Time the hot paths against a generated database and the fake CoinGecko server, offline.
+
+    python -m benchmarks.run                                  # small scale, every benchmark
+    python -m benchmarks.run --scale medium --only update_prices,portfolio_history
+    python -m benchmarks.run --latency 0.05 --throttle-every 25 -o throttled.json
+    python -m benchmarks.run --compare before.json after.json
+
+Run from the repository root. Each benchmark gets one warm-up run, `--repeat` timed runs and
+one run under tracemalloc for its peak Python memory (SQLite's own allocations are not seen).
+Results are written as JSON, by default to benchmarks/results/<commit>-<scale>.json.
+"""
+import argparse
+import gc
+import hashlib
+import http.client
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from benchmarks.generate import generate, resolve_scale, scale_arguments, write_import_file
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+IMPORT_ROWS = 10000
+# Typed while searching for a coin: short prefixes take the index path, longer ones full-text search
+SUGGESTION_QUERIES = ('b', 'co', 'bit', 'doge', 'moon inu', 'wrapped', 'chain 12', 'zzz')
+# Changes smaller than this fraction are reported as noise by --compare
+COMPARE_THRESHOLD = 0.10
+
+BENCHMARKS = []
+
+
+def benchmark(name, setup=None):
+    """
+    Register `fn(bench)` as a benchmark; `setup(bench)` runs untimed before every run.
+    """
+    def register(fn):
+        BENCHMARKS.append((name, fn, setup))
+        return fn
+    return register
+
+
+class Bench:
+    """
+    Everything the benchmarks share: the CLI on the working database, the fake API and the web server.
+    """
+
+    def __init__(self, api_server, import_path):
+        from portfolio import CoinGeckoCLI
+        self.api_server = api_server
+        self.import_path = import_path
+        self.cli = CoinGeckoCLI()
+        self.conn = self.cli.conn
+        self.portfolio = self.cli.portfolios[1]
+        self._web = None
+        self._web_connection = None
+
+    def web_get(self, path):
+        if self._web is None:
+            from webserver import PortfolioServer
+            self._web = PortfolioServer('127.0.0.1', 0)
+            self._web.start()
+            self._web_connection = http.client.HTTPConnection(*self._web.server_address[:2])
+        self._web_connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        response = self._web_connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"GET {path} returned {response.status}")
+        return body
+
+    def close(self):
+        if self._web is not None:
+            self._web_connection.close()
+            self._web.shutdown()
+            self._web.server_close()
+
+
+@benchmark('update_prices')
+def bench_update_prices(bench):
+    bench.portfolio.update_prices()
+
+
+@benchmark('update_prices_per_coin')
+def bench_update_prices_per_coin(bench):
+    bench.portfolio.update_prices(batched=False)
+
+
+@benchmark('refresh_all_prices')
+def bench_refresh_all_prices(bench):
+    from prices import refresh_all_prices
+    # A negative freshness window makes every stored price stale
+    refresh_all_prices(bench.conn, bench.cli.fetcher, freshness_seconds=-1)
+
+
+@benchmark('portfolio_value')
+def bench_portfolio_value(bench):
+    bench.portfolio.get_portfolio_value()
+
+
+@benchmark('portfolio_value_other_currency')
+def bench_portfolio_value_other_currency(bench):
+    bench.portfolio.get_portfolio_value('eur')
+
+
+@benchmark('total_value')
+def bench_total_value(bench):
+    from prices import portfolio_value
+    portfolio_value(bench.conn.cursor(), 'usd')
+
+
+@benchmark('portfolio_history')
+def bench_portfolio_history(bench):
+    bench.portfolio.get_portfolio_history()
+
+
+@benchmark('portfolio_history_last_day')
+def bench_portfolio_history_last_day(bench):
+    bench.portfolio.get_portfolio_history(start=datetime.now() - timedelta(days=1))
+
+
+@benchmark('coin_suggestions')
+def bench_coin_suggestions(bench):
+    for query in SUGGESTION_QUERIES:
+        suggestions, next_after = bench.cli.get_coin_suggestions(query)
+        if next_after:
+            bench.cli.get_coin_suggestions(query, next_after)
+
+
+@benchmark('profit_and_loss')
+def bench_profit_and_loss(bench):
+    bench.portfolio.get_profit_and_loss()
+
+
+def reset_ledger(bench):
+    from database import transaction
+    from ledger import reset_checkpoints
+    with transaction(bench.conn) as cursor:
+        reset_checkpoints(cursor, bench.portfolio.portfolio_id)
+
+
+@benchmark('profit_and_loss_cold', setup=reset_ledger)
+def bench_profit_and_loss_cold(bench):
+    bench.portfolio.get_profit_and_loss()
+
+
+def new_import_portfolio(bench):
+    from database import transaction
+    with transaction(bench.conn) as cursor:
+        cursor.execute('''INSERT INTO portfolios (name, currency) VALUES (?, 'usd')''',
+                       (f'import-{time.monotonic_ns()}',))
+        bench.import_portfolio_id = cursor.lastrowid
+    bench.cli.load_portfolios()
+
+
+@benchmark('import_csv', setup=new_import_portfolio)
+def bench_import_csv(bench):
+    report = bench.cli.portfolios[bench.import_portfolio_id].import_transactions(bench.import_path)
+    if report['failed']:
+        raise RuntimeError(f"{report['failed']} rows failed to import: {report['errors'][:3]}")
+
+
+def forget_coin_list(bench):
+    from database import transaction
+    with transaction(bench.conn) as cursor:
+        cursor.execute('''DELETE FROM sync_state''')
+
+
+@benchmark('sync_coin_list', setup=forget_coin_list)
+def bench_sync_coin_list(bench):
+    if not bench.cli.refresh_coingecko_list():
+        raise RuntimeError("coin list sync failed")
+
+
+@benchmark('sync_coin_list_not_modified')
+def bench_sync_coin_list_not_modified(bench):
+    if not bench.cli.refresh_coingecko_list():
+        raise RuntimeError("coin list sync failed")
+
+
+@benchmark('web_value')
+def bench_web_value(bench):
+    bench.web_get('/api/portfolios/1/value')
+
+
+@benchmark('web_history')
+def bench_web_history(bench):
+    bench.web_get('/api/portfolios/1/history')
+
+
+def measure(bench, fn, setup, repeat):
+    """
+    Return the timings of `repeat` runs after a warm-up, and the tracemalloc peak of one more run.
+    """
+    def run_once(traced=False):
+        if setup:
+            setup(bench)
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        fn(bench)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return elapsed, peak
+
+    run_once()
+    before = bench.api_server.counters()
+    times = [run_once()[0] for _ in range(repeat)]
+    after = bench.api_server.counters()
+    peak = run_once(traced=True)[1]
+    return {
+        'runs': repeat,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'peak_memory_bytes': peak,
+        'http_requests_per_run': (after['requests'] - before['requests']) / repeat,
+        'http_429_per_run': (after['throttled'] - before['throttled']) / repeat,
+    }
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def prepare_database(workdir, scale, seed, regenerate=False):
+    """
+    Generate the pristine database for `scale` once per workdir and return a fresh working copy.
+    """
+    key = hashlib.sha1(json.dumps([scale, seed], sort_keys=True).encode()).hexdigest()[:10]
+    pristine = os.path.join(workdir, f'bench-{key}.db')
+    if regenerate or not os.path.exists(pristine):
+        print(f"Generating database ({', '.join(f'{name}={value}' for name, value in scale.items())})...")
+        started = time.perf_counter()
+        held = generate(pristine + '.tmp', seed=seed, **scale)
+        os.replace(pristine + '.tmp', pristine)
+        with open(pristine + '.held', 'w') as held_file:
+            json.dump(held, held_file)
+        print(f"Generated in {time.perf_counter() - started:.1f}s")
+    working = os.path.join(workdir, 'bench-run.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(working + suffix):
+            os.remove(working + suffix)
+    shutil.copyfile(pristine, working)
+    with open(pristine + '.held') as held_file:
+        held = json.load(held_file)
+    return working, held
+
+
+def database_stats(path):
+    conn = sqlite3.connect(path)
+    try:
+        stats = {'file_bytes': os.path.getsize(path)}
+        for table in ('crypto_lookup', 'transactions', 'positions', 'history_snapshots', 'history_positions',
+                      'history_rollups', 'price_snapshots'):
+            stats[f'{table}_rows'] = conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+        return stats
+    finally:
+        conn.close()
+
+
+def run(args):
+    from benchmarks.fake_coingecko import FakeCoinGeckoServer
+
+    scale = resolve_scale(args)
+    selected = [entry for entry in BENCHMARKS if not args.only or entry[0] in args.only.split(',')]
+    unknown = set(args.only.split(',')) - {name for name, _, _ in BENCHMARKS} if args.only else set()
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='portfolio-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    db_path, held = prepare_database(workdir, scale, args.seed, args.regenerate)
+    stats = database_stats(db_path)
+    import_path = os.path.join(workdir, 'import.csv')
+    write_import_file(import_path, held, IMPORT_ROWS, args.seed)
+
+    api_server = FakeCoinGeckoServer(scale['coins'], latency=args.latency, jitter=args.jitter,
+                                     throttle_every=args.throttle_every, retry_after=args.retry_after,
+                                     seed=args.seed)
+    api_server.start()
+    # Everything the code under test reads from the environment points at the local files and server
+    os.environ.update({
+        'PORTFOLIO_DB': db_path,
+        'COINGECKO_API_URL': api_server.url,
+        'COINGECKO_RATE_LIMIT': str(args.rate_limit),
+        'API_KEY': '',
+        'PRICE_PROVIDERS': 'coingecko',
+        'STORE_RAW_PAYLOADS': 'false',
+    })
+
+    results = {}
+    bench = None
+    try:
+        with redirect_stdout(io.StringIO()):
+            bench = Bench(api_server, import_path)
+        for name, fn, setup in selected:
+            with redirect_stdout(io.StringIO()):
+                result = measure(bench, fn, setup, args.repeat)
+            results[name] = result
+            print(f"{name:<32} median {result['median'] * 1000:10.2f} ms   min {result['min'] * 1000:10.2f} ms   "
+                  f"peak {result['peak_memory_bytes'] / 1e6:8.2f} MB   {result['http_requests_per_run']:g} requests")
+    finally:
+        if bench is not None:
+            bench.close()
+        api_server.shutdown()
+        api_server.server_close()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = current_commit()
+    report = {
+        'commit': commit,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'scale': dict(scale, name=args.scale, seed=args.seed),
+        'database': stats,
+        'api': {'latency': args.latency, 'jitter': args.jitter, 'throttle_every': args.throttle_every,
+                'retry_after': args.retry_after, 'rate_limit': args.rate_limit},
+        'repeat': args.repeat,
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f'{commit}-{args.scale}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+def compare(before_path, after_path, threshold=COMPARE_THRESHOLD):
+    """
+    Print the median time and peak memory of each benchmark in two result files side by side.
+    """
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    if before['scale'] != after['scale'] or before['api'] != after['api']:
+        print("Warning: the runs used different scales or API settings.")
+    print(f"{'benchmark':<32} {before['commit']:>14} {after['commit']:>14} {'change':>8}   {'memory':>8}")
+    for name in sorted(set(before['results']) | set(after['results'])):
+        old, new = before['results'].get(name), after['results'].get(name)
+        if old is None or new is None:
+            print(f"{name:<32} {'-' if old is None else '%.2f ms' % (old['median'] * 1000):>14} "
+                  f"{'-' if new is None else '%.2f ms' % (new['median'] * 1000):>14}")
+            continue
+        change = (new['median'] - old['median']) / old['median'] if old['median'] else 0.0
+        memory = ((new['peak_memory_bytes'] - old['peak_memory_bytes']) / old['peak_memory_bytes']
+                  if old['peak_memory_bytes'] else 0.0)
+        verdict = '' if abs(change) < threshold else ('slower' if change > 0 else 'faster')
+        print(f"{name:<32} {old['median'] * 1000:11.2f} ms {new['median'] * 1000:11.2f} ms {change:+8.1%}   "
+              f"{memory:+8.1%}  {verdict}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the portfolio tracker offline.")
+    scale_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per benchmark (default: 5)")
+    parser.add_argument('--only', help="Comma separated benchmark names")
+    parser.add_argument('--list', action='store_true', help="List the benchmarks and exit")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the fake API adds to each response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many extra seconds, at random")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Fake API answers every Nth request with 429")
+    parser.add_argument('--retry-after', type=float, default=0.1, help="Retry-After seconds sent with each 429")
+    parser.add_argument('--rate-limit', type=float, default=100000, help="Fetcher calls per minute")
+    parser.add_argument('--workdir', help="Keep generated databases here and reuse them between runs")
+    parser.add_argument('--regenerate', action='store_true', help="Regenerate the database even if cached")
+    parser.add_argument('-o', '--output', help="Result file (default: benchmarks/results/<commit>-<scale>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="Compare two result files")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.list:
+        for name, _, _ in BENCHMARKS:
+            print(name)
+        return 0
+    if args.compare:
+        return compare(*args.compare)
+    if args.repeat < 1:
+        print("--repeat must be at least 1", file=sys.stderr)
+        return 2
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import codecs
+import hashlib
+from datetime import datetime
+
+from database import transaction
+from importer import iter_json_array
+from instrumentation import phase, timed
+from sql_queries import (
+    CLEAR_SEEN_COINS,
+    COUNT_CHANGED_COINS,
+    COUNT_LISTED_COINS,
+    COUNT_NEW_COINS,
+    COUNT_UNSEEN_COINS,
+    CREATE_SEEN_COINS_TABLE,
+    DELIST_UNSEEN_COINS,
+    INSERT_SEEN_COIN,
+    SELECT_SYNC_STATE,
+    UPSERT_COINS_FROM_SEEN,
+    UPSERT_SYNC_STATE,
+)
+
+COIN_LIST_PATH = 'coins/list'
+SYNC_BATCH_SIZE = 2000
+# A sync that would delist more than this share of listed coins is treated as a bad download
+MAX_DELISTED_FRACTION = 0.2
+
+
+class HashingReader:
+    """
+    Text reader over a response's byte stream that hashes the bytes as they go by.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.digest.update(data)
+        return self.decoder.decode(data, final=not data)
+
+
+@timed('sync_coin_list')
+def sync_coin_list(conn, fetcher, force=False):
+    """
+    Bring crypto_lookup in line with /coins/list without holding the list in memory.
+
+    The request is conditional on the last ETag/Last-Modified, and the body is streamed into a
+    temporary table while it is hashed. Nothing is written to the database when the server says
+    304 or the hash matches the last sync; otherwise new and renamed coins are upserted in one
+    statement, coins missing from the list get delisted_at, and reappearing coins are relisted.
+
+    Returns {'status': 'not_modified' | 'unchanged' | 'updated', 'coins', 'added', 'changed',
+    'delisted', 'delisting_skipped'}, or None if the list could not be fetched.
+    """
+    cursor = conn.cursor()
+    cursor.execute(SELECT_SYNC_STATE, (COIN_LIST_PATH,))
+    etag, last_modified, content_hash = cursor.fetchone() or (None, None, None)
+    headers = {}
+    if not force:
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    report = {'status': 'not_modified', 'coins': 0, 'added': 0, 'changed': 0, 'delisted': 0,
+              'delisting_skipped': False}
+    with phase('download'):
+        response = fetcher.open(COIN_LIST_PATH, headers=headers)
+        if response is None:
+            return None
+        try:
+            if response.status_code == 304:
+                return report
+            response.raw.decode_content = True
+            reader = HashingReader(response.raw)
+            cursor.execute(CREATE_SEEN_COINS_TABLE)
+            cursor.execute(CLEAR_SEEN_COINS)
+            batch = []
+            for coin in iter_json_array(reader):
+                batch.append((coin['id'], coin.get('symbol'), coin.get('name')))
+                if len(batch) >= SYNC_BATCH_SIZE:
+                    cursor.executemany(INSERT_SEEN_COIN, batch)
+                    report['coins'] += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(INSERT_SEEN_COIN, batch)
+                report['coins'] += len(batch)
+            new_etag = response.headers.get('ETag')
+            new_last_modified = response.headers.get('Last-Modified')
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            response.close()
+
+    new_hash = reader.digest.hexdigest()
+    synced_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with phase('apply'), transaction(conn) as cursor:
+        if new_hash == content_hash and not force:
+            report['status'] = 'unchanged'
+            if (new_etag, new_last_modified) != (etag, last_modified):
+                cursor.execute(UPSERT_SYNC_STATE, (COIN_LIST_PATH, new_etag, new_last_modified, new_hash, synced_at))
+            cursor.execute(CLEAR_SEEN_COINS)
+            return report
+
+        report['status'] = 'updated'
+        report['added'] = cursor.execute(COUNT_NEW_COINS).fetchone()[0]
+        report['changed'] = cursor.execute(COUNT_CHANGED_COINS).fetchone()[0]
+        cursor.execute(UPSERT_COINS_FROM_SEEN)
+
+        # An empty or truncated download must not wipe the list
+        unseen = cursor.execute(COUNT_UNSEEN_COINS).fetchone()[0]
+        listed = cursor.execute(COUNT_LISTED_COINS).fetchone()[0]
+        if unseen and (report['coins'] == 0 or (unseen > MAX_DELISTED_FRACTION * listed and not force)):
+            report['delisting_skipped'] = True
+        elif unseen:
+            cursor.execute(DELIST_UNSEEN_COINS, (synced_at,))
+            report['delisted'] = cursor.rowcount
+        cursor.execute(CLEAR_SEEN_COINS)
+        if not report['delisting_skipped']:
+            # Remember the list only once it has been fully applied
+            cursor.execute(UPSERT_SYNC_STATE, (COIN_LIST_PATH, new_etag, new_last_modified, new_hash, synced_at))
+    return report
@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from history import prune_history, record_snapshot
+from instrumentation import InstrumentedConnection
+from sql_queries import (
+    CREATE_PORTFOLIOS_TABLE,
+    CREATE_TRANSACTIONS_TABLE,
+    CREATE_COINS_TABLE,
+    CREATE_CRYPTOLOOKUP_TABLE,
+    CREATE_HISTORY_TABLE,
+    CREATE_POSITIONS_TABLE,
+    DELETE_POSITIONS,
+    REBUILD_POSITIONS,
+    DEDUPLICATE_COINS,
+    CREATE_COINS_COIN_ID_INDEX,
+    CREATE_TRANSACTIONS_PORTFOLIO_COIN_INDEX,
+    CREATE_HISTORY_PORTFOLIO_DATE_INDEX,
+    CREATE_PRICE_SNAPSHOTS_TABLE,
+    UPSERT_PRICE_SNAPSHOT,
+    CREATE_CRYPTOLOOKUP_FTS_TABLE,
+    CREATE_CRYPTOLOOKUP_FTS_TRIGGERS,
+    POPULATE_CRYPTOLOOKUP_FTS,
+    CREATE_CRYPTOLOOKUP_SYMBOL_INDEX,
+    CREATE_HISTORY_SNAPSHOTS_TABLE,
+    CREATE_HISTORY_POSITIONS_TABLE,
+    CREATE_HISTORY_ROLLUPS_TABLE,
+    CREATE_PRICE_SERIES_TABLE,
+    CREATE_LEDGER_CHECKPOINTS_TABLE,
+    CREATE_TRANSACTIONS_LEDGER_INDEX,
+    CREATE_SYNC_STATE_TABLE,
+    ADD_CRYPTOLOOKUP_DELISTED_AT,
+    CREATE_CRYPTOLOOKUP_LISTING_TRIGGERS,
+    CREATE_PROVIDER_COIN_IDS_TABLE,
+    RENAME_POSITIONS_TOTAL_COST,
+    ADD_PRICE_SNAPSHOTS_CHANGES_UPDATED,
+)
+
+DEFAULT_DB_PATH = 'portfolio.db'
+# WAL lets readers (the CLI, the web viewer) keep working while a refresh writes
+DEFAULT_JOURNAL_MODE = 'wal'
+# NORMAL is durable in WAL mode except for the last commits before a power loss, and skips most fsyncs
+DEFAULT_SYNCHRONOUS = 'normal'
+# How long a writer waits for another process's write lock before "database is locked"
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+# Percentage change windows stored in price_snapshots, in column order
+PRICE_CHANGE_PERIODS = ('1h', '24h', '7d', '14d', '30d', '60d', '200d', '1y')
+
+
+def rebuild_positions(cursor, portfolio_id=None):
+    """
+    Recompute the positions table from transactions, for one portfolio or all of them.
+    """
+    params = {'portfolio_id': portfolio_id}
+    cursor.execute(DELETE_POSITIONS, params)
+    cursor.execute(REBUILD_POSITIONS, params)
+
+
+def price_snapshot_rows(coin_id, coin_data, last_updated):
+    """
+    Extract one price_snapshots row per quote currency from a /coins/{id} style payload.
+    """
+    market_data = coin_data.get('market_data') or {}
+    rows = []
+    for vs_currency, price in (market_data.get('current_price') or {}).items():
+        if price is None:
+            continue
+        changes = [(market_data.get(f'price_change_percentage_{period}_in_currency') or {}).get(vs_currency)
+                   for period in PRICE_CHANGE_PERIODS]
+        rows.append((coin_id, vs_currency, price, *changes, last_updated))
+    return rows
+
+
+def store_price_snapshots(cursor, coin_id, coin_data, last_updated):
+    cursor.executemany(UPSERT_PRICE_SNAPSHOT, price_snapshot_rows(coin_id, coin_data, last_updated))
+
+
+def _snapshot_stored_payloads(cursor):
+    # Reads with a separate cursor so rows stream while snapshots are written
+    reader = cursor.connection.cursor()
+    reader.execute('''SELECT coin_id, coin_data, last_updated FROM coins WHERE coin_data IS NOT NULL''')
+    for coin_id, coin_json, last_updated in reader:
+        try:
+            coin_data = json.loads(coin_json)
+        except ValueError:
+            continue
+        store_price_snapshots(cursor, coin_id, coin_data, last_updated)
+
+
+def compact_database(conn):
+    """
+    Move any stored raw payloads into price_snapshots, drop them and VACUUM the file.
+    """
+    cursor = conn.cursor()
+    _snapshot_stored_payloads(cursor)
+    cursor.execute('''UPDATE coins SET coin_data = NULL WHERE coin_data IS NOT NULL''')
+    conn.commit()
+    conn.execute('VACUUM')
+    # VACUUM goes through the WAL; fold it back into the main file and truncate the log
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def _create_base_tables(cursor):
+    for table_query in (
+        CREATE_PORTFOLIOS_TABLE,
+        CREATE_TRANSACTIONS_TABLE,
+        CREATE_COINS_TABLE,
+        CREATE_CRYPTOLOOKUP_TABLE,
+        CREATE_HISTORY_TABLE,
+        CREATE_POSITIONS_TABLE,
+    ):
+        cursor.execute(table_query)
+
+
+def _backfill_positions(cursor):
+    # Databases created before migrations existed may still have the old column name
+    _rename_positions_total_cost(cursor)
+    # Databases created before the positions table existed have an empty one
+    rebuild_positions(cursor)
+
+
+def _deduplicate_coins_and_add_indexes(cursor):
+    # INSERT OR REPLACE never replaced anything without a unique coin_id,
+    # so every refresh appended another row for each coin
+    cursor.execute(DEDUPLICATE_COINS)
+    cursor.execute(CREATE_COINS_COIN_ID_INDEX)
+    cursor.execute(CREATE_TRANSACTIONS_PORTFOLIO_COIN_INDEX)
+    cursor.execute(CREATE_HISTORY_PORTFOLIO_DATE_INDEX)
+
+
+def _create_price_snapshots(cursor):
+    cursor.execute(CREATE_PRICE_SNAPSHOTS_TABLE)
+    _snapshot_stored_payloads(cursor)
+
+
+def _create_coin_search_index(cursor):
+    cursor.execute(CREATE_CRYPTOLOOKUP_FTS_TABLE)
+    for trigger_query in CREATE_CRYPTOLOOKUP_FTS_TRIGGERS:
+        cursor.execute(trigger_query)
+    cursor.execute(POPULATE_CRYPTOLOOKUP_FTS)
+    cursor.execute(CREATE_CRYPTOLOOKUP_SYMBOL_INDEX)
+
+
+def _normalize_history(cursor):
+    for table_query in (
+        CREATE_HISTORY_SNAPSHOTS_TABLE,
+        CREATE_HISTORY_POSITIONS_TABLE,
+        CREATE_HISTORY_ROLLUPS_TABLE,
+    ):
+        cursor.execute(table_query)
+
+    # Replay the JSON snapshots in time order so the rollups come out right, then drop them
+    reader = cursor.connection.cursor()
+    reader.execute('''SELECT portfolio_id, portfolio_data, last_updated FROM history
+                      ORDER BY portfolio_id, last_updated''')
+    portfolio_ids = set()
+    for portfolio_id, portfolio_json, last_updated in reader:
+        try:
+            portfolio_data = json.loads(portfolio_json)
+        except (TypeError, ValueError):
+            continue
+        coins = {coin_id: (details.get('amount') or 0, details.get('price') or 0)
+                 for coin_id, details in portfolio_data.get('coins', {}).items()}
+        record_snapshot(cursor, portfolio_id, last_updated, coins, prune=False)
+        portfolio_ids.add(portfolio_id)
+    for portfolio_id in portfolio_ids:
+        prune_history(cursor, portfolio_id)
+    cursor.execute('''DROP TABLE IF EXISTS history''')
+
+
+def _create_price_series(cursor):
+    cursor.execute(CREATE_PRICE_SERIES_TABLE)
+
+
+def _create_ledger_checkpoints(cursor):
+    cursor.execute(CREATE_LEDGER_CHECKPOINTS_TABLE)
+    cursor.execute('DROP INDEX IF EXISTS idx_transactions_portfolio_coin')
+    cursor.execute(CREATE_TRANSACTIONS_LEDGER_INDEX)
+
+
+def _track_coin_listings(cursor):
+    cursor.execute(ADD_CRYPTOLOOKUP_DELISTED_AT)
+    for trigger_query in CREATE_CRYPTOLOOKUP_LISTING_TRIGGERS:
+        cursor.execute(trigger_query)
+    cursor.execute(CREATE_SYNC_STATE_TABLE)
+
+
+def _create_provider_coin_ids(cursor):
+    cursor.execute(CREATE_PROVIDER_COIN_IDS_TABLE)
+
+
+def _rename_positions_total_cost(cursor):
+    # New databases already create the column as net_invested
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(positions)').fetchall()]
+    if 'total_cost' in columns:
+        cursor.execute(RENAME_POSITIONS_TOTAL_COST)
+
+
+def _track_price_change_freshness(cursor):
+    # Left NULL, so the next refresh fetches the change windows of every held pair once
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(price_snapshots)').fetchall()]
+    if 'changes_updated' not in columns:
+        cursor.execute(ADD_PRICE_SNAPSHOTS_CHANGES_UPDATED)
+
+
+# Applied in order; a database at PRAGMA user_version N has run the first N entries.
+# Only ever append to this list.
+MIGRATIONS = [
+    _create_base_tables,
+    _backfill_positions,
+    _deduplicate_coins_and_add_indexes,
+    _create_price_snapshots,
+    _create_coin_search_index,
+    _normalize_history,
+    _create_price_series,
+    _create_ledger_checkpoints,
+    _track_coin_listings,
+    _create_provider_coin_ids,
+    _rename_positions_total_cost,
+    _track_price_change_freshness,
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database schema up to date, one transaction per migration.
+    """
+    version = schema_version(conn)
+    for target_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN')
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {target_version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+
+def configure(conn, journal_mode=None, synchronous=None, busy_timeout=None):
+    """
+    Apply journal mode, synchronous level and busy timeout, defaulting to the PORTFOLIO_DB_JOURNAL_MODE,
+    PORTFOLIO_DB_SYNCHRONOUS and PORTFOLIO_DB_BUSY_TIMEOUT (milliseconds) environment variables.
+    """
+    journal_mode = (journal_mode or os.getenv("PORTFOLIO_DB_JOURNAL_MODE") or DEFAULT_JOURNAL_MODE).lower()
+    synchronous = (synchronous or os.getenv("PORTFOLIO_DB_SYNCHRONOUS") or DEFAULT_SYNCHRONOUS).lower()
+    if busy_timeout is None:
+        busy_timeout = int(os.getenv("PORTFOLIO_DB_BUSY_TIMEOUT", DEFAULT_BUSY_TIMEOUT_MS))
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Unsupported journal mode '{journal_mode}'")
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Unsupported synchronous level '{synchronous}'")
+
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    # The journal mode is stored in the file for WAL, so this is a no-op after the first connection
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    return conn
+
+
+def connect(path=None, check_same_thread=True):
+    """
+    Open a new connection to the portfolio database (PORTFOLIO_DB, default portfolio.db), configure and migrate it.
+    """
+    conn = sqlite3.connect(path or os.getenv("PORTFOLIO_DB") or DEFAULT_DB_PATH, check_same_thread=check_same_thread,
+                           factory=InstrumentedConnection)
+    configure(conn)
+    migrate(conn)
+    return conn
+
+
+_shared_connection = None
+_shared_connection_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    Return the process-wide connection, opening and migrating it on first use.
+    """
+    global _shared_connection
+    with _shared_connection_lock:
+        if _shared_connection is None:
+            _shared_connection = connect()
+        return _shared_connection
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Unit of work: commit everything done inside the block, or roll it all back on error.
+
+    The write lock is taken at the first write statement, so do network calls before the first
+    write (or before entering the block) to keep other writers from waiting on them.
+    """
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
@@ -0,0 +1,240 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import metrics
+
+DEFAULT_API_URL = "https://api.coingecko.com/api/v3"
+# The demo plan allows 30 calls per minute
+DEFAULT_RATE_LIMIT = 30
+DEFAULT_MAX_WORKERS = 4
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# Endpoints whose second path segment is a fixed name rather than a coin id
+FIXED_ENDPOINTS = {('coins', 'list'), ('coins', 'markets')}
+
+
+def endpoint_label(path):
+    """
+    Metric label for an API path with the coin id collapsed, e.g. coins/{id}/market_chart/range.
+    """
+    parts = urlsplit(path).path.strip('/').split('/')
+    if len(parts) >= 2 and (parts[0], parts[1]) not in FIXED_ENDPOINTS and parts[0] in ('coins', 'tickers'):
+        parts[1] = '{id}'
+    return '/'.join(parts)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every request a fetcher makes.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = max(self.updated, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate + max(0.0, self.updated - now)
+            metrics.count('rate_limit_wait_seconds_total', wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Drain the bucket and stop refilling it for `seconds`, e.g. after a 429.
+        """
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+class CoinGeckoFetcher:
+    """
+    Pooled, concurrent and rate limited HTTP client for the CoinGecko API.
+
+    Settings default to the COINGECKO_API_URL, COINGECKO_RATE_LIMIT (calls per
+    minute) and COINGECKO_MAX_WORKERS environment variables, so the fetcher can
+    be pointed at a local fake server.
+    """
+
+    def __init__(self, base_url=None, api_key=None, max_workers=None, rate_limit=None, burst=None,
+                 timeout=10, max_retries=3, backoff=1.0, max_backoff=60.0):
+        self.base_url = (base_url or os.getenv("COINGECKO_API_URL") or DEFAULT_API_URL).rstrip('/')
+        self.api_label = urlsplit(self.base_url).hostname or self.base_url
+        self.api_key = api_key if api_key is not None else os.getenv("API_KEY")
+        self.max_workers = max_workers or int(os.getenv("COINGECKO_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+        rate_limit = rate_limit or float(os.getenv("COINGECKO_RATE_LIMIT", DEFAULT_RATE_LIMIT))
+        self.bucket = TokenBucket(rate_limit / 60.0, burst or self.max_workers)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, params=None, keyed=False, retries=None, headers=None, stream=False):
+        """
+        GET `path` with rate limiting and jittered retries.
+
+        Returns the last response received, or None if the server could not be reached.
+        """
+        retries = self.max_retries if retries is None else retries
+        headers = dict(headers or {})
+        if keyed and self.api_key:
+            headers["x-cg-demo-api-key"] = self.api_key
+        response = None
+        endpoint = endpoint_label(path)
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.count('http_retries_total', api=self.api_label, endpoint=endpoint)
+            self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(self.url(path), params=params, headers=headers or None,
+                                            timeout=self.timeout, stream=stream)
+            except requests.RequestException:
+                response = None
+            self._record(endpoint, response, time.perf_counter() - started, stream)
+            if response is not None and response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            if attempt == retries:
+                break
+            delay = self._backoff_delay(attempt)
+            if response is not None:
+                # Hand the connection back to the pool before retrying
+                response.close()
+                if response.status_code == 429:
+                    self.bucket.pause(self._retry_after(response) or delay)
+                    continue
+            time.sleep(delay)
+        return response
+
+    def get_json(self, path, params=None):
+        """
+        Fetch and decode `path`, trying the public endpoint once before falling back to the API key.
+
+        Returns None if the request did not succeed.
+        """
+        if self.api_key:
+            response = self.get(path, params, retries=0)
+            if response is None or response.status_code != 200:
+                response = self.get(path, params, keyed=True)
+        else:
+            response = self.get(path, params)
+        if response is not None and response.status_code == 200:
+            with metrics.timer('json_decode_seconds', api=self.api_label, endpoint=endpoint_label(path)):
+                return response.json()
+        return None
+
+    def open(self, path, params=None, headers=None):
+        """
+        Like get_json, but return the streaming 200 or 304 response for the caller to read and close.
+
+        Returns None if the request did not succeed.
+        """
+        response = None
+        if self.api_key:
+            response = self.get(path, params, retries=0, headers=headers, stream=True)
+        if response is None or response.status_code not in (200, 304):
+            if response is not None:
+                response.close()
+            response = self.get(path, params, keyed=bool(self.api_key), headers=headers, stream=True)
+        if response is not None and response.status_code in (200, 304):
+            return response
+        if response is not None:
+            response.close()
+        return None
+
+    def map(self, fn, items):
+        """
+        Run `fn` over `items` on the fetcher's thread pool and return the results in order.
+        """
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [fn(item) for item in items]
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self._executor.map(fn, items))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.session.close()
+
+    def _record(self, endpoint, response, elapsed, stream):
+        # A streamed body has not been read yet, so count its advertised length instead
+        status = 'error' if response is None else str(response.status_code)
+        metrics.observe('http_request_seconds', elapsed, api=self.api_label, endpoint=endpoint, status=status)
+        if response is None:
+            return
+        if stream:
+            received = int(response.headers.get('Content-Length') or 0)
+        else:
+            received = len(response.content)
+        metrics.count('http_response_bytes_total', received, api=self.api_label, endpoint=endpoint, status=status)
+        if response.status_code == 429:
+            metrics.count('http_rate_limited_total', api=self.api_label, endpoint=endpoint)
+
+    def _backoff_delay(self, attempt):
+        # Equal jitter: sleep between half and all of the exponential ceiling
+        ceiling = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher():
+    """
+    Return the process-wide fetcher so every caller shares one connection pool and rate limit.
+    """
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _default_fetcher = CoinGeckoFetcher()
+        return _default_fetcher
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+
+from sql_queries import (
+    INSERT_HISTORY_SNAPSHOT,
+    INSERT_HISTORY_POSITION,
+    UPSERT_HISTORY_ROLLUP,
+    SELECT_HISTORY_SNAPSHOTS,
+    SELECT_HISTORY_ROLLUPS,
+    SELECT_FIRST_HISTORY_TS,
+)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+ROLLUP_RESOLUTIONS = ('hour', 'day', 'week')
+RESOLUTIONS = ('raw',) + ROLLUP_RESOLUTIONS
+
+# How long each resolution is kept; None keeps it forever
+HISTORY_RETENTION = {
+    'raw': timedelta(days=7),
+    'hour': timedelta(days=90),
+    'day': timedelta(days=365 * 5),
+    'week': None,
+}
+
+# Coarsest span each resolution is picked for when none is requested, to keep charts to a few hundred points
+AUTO_RESOLUTION_SPANS = (
+    ('raw', timedelta(days=2)),
+    ('hour', timedelta(days=21)),
+    ('day', timedelta(days=550)),
+)
+
+
+def bucket_start(ts, resolution):
+    """
+    Return the start of the hour, day or ISO week containing `ts`, as a DATE_FORMAT string.
+    """
+    if resolution == 'hour':
+        return ts[:13] + ':00:00'
+    if resolution == 'day':
+        return ts[:10] + ' 00:00:00'
+    if resolution == 'week':
+        day = datetime.strptime(ts[:10], "%Y-%m-%d")
+        return (day - timedelta(days=day.weekday())).strftime(DATE_FORMAT)
+    raise ValueError(f"Unknown history resolution '{resolution}'")
+
+
+def record_snapshot(cursor, portfolio_id, ts, coins, prune=True):
+    """
+    Store one refresh: per-coin rows, the snapshot total and the rollups it falls into.
+
+    `coins` maps coin_id to (amount, price). Returns the snapshot's total value.
+    """
+    rows = [(portfolio_id, ts, coin_id, amount, price)
+            for coin_id, (amount, price) in coins.items() if amount]
+    total_value = sum(amount * price for _, _, _, amount, price in rows)
+    cursor.executemany(INSERT_HISTORY_POSITION, rows)
+    cursor.execute(INSERT_HISTORY_SNAPSHOT, (portfolio_id, ts, total_value))
+    cursor.executemany(UPSERT_HISTORY_ROLLUP, [
+        {'portfolio_id': portfolio_id, 'resolution': resolution, 'bucket': bucket_start(ts, resolution),
+         'ts': ts, 'value': total_value}
+        for resolution in ROLLUP_RESOLUTIONS
+    ])
+    if prune:
+        prune_history(cursor, portfolio_id, datetime.strptime(ts, DATE_FORMAT))
+    return total_value
+
+
+def prune_history(cursor, portfolio_id, now=None):
+    """
+    Drop snapshots and rollups that are older than their resolution's retention.
+    """
+    now = now or datetime.now()
+    for resolution, retention in HISTORY_RETENTION.items():
+        if retention is None:
+            continue
+        cutoff = (now - retention).strftime(DATE_FORMAT)
+        if resolution == 'raw':
+            cursor.execute('''DELETE FROM history_positions WHERE portfolio_id = ? AND ts < ?''',
+                           (portfolio_id, cutoff))
+            cursor.execute('''DELETE FROM history_snapshots WHERE portfolio_id = ? AND ts < ?''',
+                           (portfolio_id, cutoff))
+        else:
+            cursor.execute('''DELETE FROM history_rollups WHERE portfolio_id = ? AND resolution = ? AND bucket < ?''',
+                           (portfolio_id, resolution, bucket_start(cutoff, resolution)))
+
+
+def choose_resolution(start, end, now=None):
+    """
+    Pick the finest resolution that still covers `start` and keeps the number of points small.
+    """
+    now = now or datetime.now()
+    span = end - start
+    for resolution, max_span in AUTO_RESOLUTION_SPANS:
+        retention = HISTORY_RETENTION[resolution]
+        if span <= max_span and (retention is None or start >= now - retention):
+            return resolution
+    return 'week'
+
+
+def first_history_ts(cursor, portfolio_id):
+    """
+    Return the datetime of the portfolio's oldest retained sample, or None.
+    """
+    cursor.execute(SELECT_FIRST_HISTORY_TS, {'portfolio_id': portfolio_id})
+    first_week, first_raw = cursor.fetchone()
+    if first_raw and bucket_start(first_raw, 'week') == first_week:
+        # Raw snapshots still reach back to the first week, so they give the exact start
+        return datetime.strptime(first_raw, DATE_FORMAT)
+    return datetime.strptime(first_week, DATE_FORMAT) if first_week else None
+
+
+def parse_timestamp(value):
+    """
+    Parse a DATE_FORMAT string, or a YYYY-MM-DD date meaning midnight.
+    """
+    return datetime.strptime(value, DATE_FORMAT if len(value) > 10 else "%Y-%m-%d")
+
+
+def query_history(cursor, portfolio_id, start=None, end=None, resolution=None, after=None, limit=None):
+    """
+    Return (resolution, [(ts, total_value), ...]) for a time range, oldest first.
+
+    `start` and `end` are datetimes or strings for parse_timestamp; both default to the full history.
+    For paging, `after` skips points up to and including that timestamp and `limit` caps the count.
+    """
+    if isinstance(start, str):
+        start = parse_timestamp(start)
+    if isinstance(end, str):
+        end = parse_timestamp(end)
+    end = end or datetime.now()
+    if start is None:
+        start = first_history_ts(cursor, portfolio_id) or end
+    if resolution is None:
+        resolution = choose_resolution(start, end)
+    elif resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown history resolution '{resolution}'")
+
+    start_ts = start.strftime(DATE_FORMAT)
+    params = {'portfolio_id': portfolio_id, 'end': end.strftime(DATE_FORMAT), 'after': after,
+              'limit': -1 if limit is None else limit}
+    if resolution == 'raw':
+        cursor.execute(SELECT_HISTORY_SNAPSHOTS, dict(params, start=start_ts))
+    else:
+        # Include the bucket that contains `start`
+        cursor.execute(SELECT_HISTORY_ROLLUPS,
+                       dict(params, resolution=resolution, start=bucket_start(start_ts, resolution)))
+    return resolution, cursor.fetchall()
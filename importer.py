@@ -0,0 +1,424 @@
+import csv
+import json
+import math
+import os
+import re
+from datetime import datetime
+
+from database import transaction
+from instrumentation import timed
+from ledger import invalidate_checkpoints
+from sql_queries import APPLY_POSITION_DELTA, INSERT_TRANSACTION
+
+DEFAULT_BATCH_SIZE = 5000
+# Only the first errors are kept for the report; the rest are just counted
+MAX_REPORTED_ERRORS = 100
+# Coin ids named in an "ambiguous ticker" error
+MAX_LISTED_MATCHES = 5
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# CoinGecko ids are lowercase slugs; a hyphen never appears in a ticker
+CANONICAL_COIN_ID = re.compile(r'[a-z0-9]+(?:-[a-z0-9]+)+')
+
+# Column names used by exchange exports, mapped to our transaction fields. `coin_id` holds
+# CoinGecko ids and `symbol` holds exchange tickers, which are resolved through crypto_lookup.
+FIELD_ALIASES = {
+    'coin_id': ('coin_id',),
+    'symbol': ('coin', 'asset', 'symbol'),
+    'amount': ('amount', 'quantity', 'qty', 'size', 'filled'),
+    'price_per_coin': ('price_per_coin', 'price', 'rate', 'unit_price'),
+    'date': ('date', 'time', 'timestamp', 'datetime', 'date(utc)', 'created_at'),
+    'transaction_type': ('transaction_type', 'type', 'side'),
+}
+
+FORMATS = ('json', 'jsonl', 'csv')
+
+
+def iter_json_array(fp, chunk_size=65536):
+    """
+    Yield the elements of a top-level JSON array from a text stream without loading it all.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    # What may come next: '[' (start), a value or ']' (first), a value (after a comma), ',' or ']' (next)
+    state = 'start'
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = fp.read(chunk_size)
+        if chunk:
+            buffer = buffer[position:] + chunk
+            position = 0
+        else:
+            eof = True
+
+    while True:
+        # Skip whitespace; refill if we run off the end of the buffer
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position >= len(buffer):
+            if eof:
+                raise json.JSONDecodeError("Unexpected end of JSON array", buffer, position)
+            fill()
+            continue
+
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise json.JSONDecodeError("Expected a JSON array", buffer, position)
+            state = 'first'
+            position += 1
+            continue
+        if state == 'next':
+            if char == ']':
+                return
+            if char != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+            state = 'value'
+            position += 1
+            continue
+        if char == ']' and state == 'first':
+            return
+        if char in ',]':
+            raise json.JSONDecodeError("Expecting value", buffer, position)
+
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        # A value that ends exactly at the buffer edge may be truncated (e.g. a number)
+        if end >= len(buffer) and not eof:
+            fill()
+            continue
+        position = end
+        state = 'next'
+        yield value
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if extension in ('.csv', '.tsv'):
+        return 'csv'
+    return 'json'
+
+
+def normalize_date(value):
+    """
+    Accept unix timestamps (seconds or milliseconds) and ISO 8601 strings; return local time in DATE_FORMAT.
+    """
+    if value is None or value == '':
+        raise ValueError("missing date")
+    if isinstance(value, str):
+        value = value.strip()
+        # Already in our storage format
+        if len(value) == 19 and value[10] == ' ' and value[4] == '-':
+            return value
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if isinstance(value, (int, float)):
+        timestamp = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"unrecognised date '{value}'")
+    if parsed.tzinfo is not None:
+        parsed = datetime.fromtimestamp(parsed.timestamp())
+    return parsed.isoformat(sep=' ', timespec='seconds')
+
+
+def _canonical_columns(names):
+    """
+    Map each transaction field to the first matching column in `names`, or None.
+    """
+    lowered = [str(name).strip().lower() for name in names]
+    columns = {}
+    for field, aliases in FIELD_ALIASES.items():
+        columns[field] = next((lowered.index(alias) for alias in aliases if alias in lowered), None)
+    return columns
+
+
+def _canonical_record(record):
+    record = {str(key).strip().lower(): value for key, value in record.items()}
+    canonical = {}
+    for field, aliases in FIELD_ALIASES.items():
+        canonical[field] = next((record[alias] for alias in aliases if record.get(alias) not in (None, '')), None)
+    return canonical
+
+
+def _number(value, name):
+    try:
+        number = float(str(value).replace(',', '')) if isinstance(value, str) else float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {name} '{value}'")
+    if not math.isfinite(number):
+        raise ValueError(f"invalid {name} '{value}'")
+    return number
+
+
+class BulkImporter:
+    """
+    Streams transactions from JSON, JSONL or CSV files into a portfolio in batches.
+
+    Rows are validated as they are read and written with executemany in batches. A sell larger
+    than the running holding is held back and checked against the holding after the whole file,
+    so exports listed newest first import too. The whole import is one transaction, so an
+    interrupted import leaves the portfolio untouched and costs a single fsync.
+    """
+
+    def __init__(self, conn, portfolio_id, batch_size=DEFAULT_BATCH_SIZE):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.portfolio_id = portfolio_id
+        self.batch_size = batch_size
+        self._coin_id_cache = {}
+        self._warnings = []
+
+    def import_file(self, path, file_format=None):
+        """
+        Import `path` and return {'imported': int, 'failed': int, 'errors': [(row_number, message)],
+        'warnings': [(row_number, message)]}.
+        """
+        file_format = file_format or detect_format(path)
+        if file_format not in FORMATS:
+            raise ValueError(f"Unsupported import format '{file_format}'")
+        with open(path, 'r', newline='', encoding='utf-8-sig') as fp:
+            return self.import_records(self._iter_records(fp, file_format))
+
+    def import_records(self, records):
+        """
+        Import an iterable of (row_number, record) pairs, with records keyed by FIELD_ALIASES names.
+        """
+        report = {'imported': 0, 'failed': 0, 'errors': [], 'warnings': []}
+        self.cursor.execute('''SELECT coin_id, amount FROM positions WHERE portfolio_id = ?''', (self.portfolio_id,))
+        holdings = dict(self.cursor.fetchall())
+
+        def reject(row_number, message):
+            report['failed'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append((row_number, message))
+
+        batch = []
+        # Sells that the holding did not cover yet, e.g. listed before the buys that fund them
+        deferred = []
+        with transaction(self.conn):
+            for row_number, record in records:
+                try:
+                    row = self._validate(record)
+                except ValueError as error:
+                    reject(row_number, str(error))
+                    continue
+                report['warnings'].extend((row_number, message) for message in self._warnings)
+                if not self._apply_holding(row, holdings):
+                    deferred.append((row_number, row))
+                    continue
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self._write_batch(batch)
+                    report['imported'] += len(batch)
+                    batch = []
+
+            # Like add_transaction, a sell only needs the net holding to cover it
+            for row_number, row in sorted(deferred, key=lambda item: (item[1][4], item[0])):
+                if self._apply_holding(row, holdings):
+                    batch.append(row)
+                else:
+                    coin_id, amount = row[1], -row[2]
+                    reject(row_number, f"insufficient holding to sell {amount} {coin_id} "
+                                       f"(have {holdings.get(coin_id, 0)})")
+            if batch:
+                for start in range(0, len(batch), self.batch_size):
+                    self._write_batch(batch[start:start + self.batch_size])
+                report['imported'] += len(batch)
+        report['errors'].sort()
+        return report
+
+    def _iter_records(self, fp, file_format):
+        if file_format == 'csv':
+            dialect = csv.excel_tab if fp.name.lower().endswith('.tsv') else csv.excel
+            reader = csv.reader(fp, dialect=dialect)
+            header = next(reader, [])
+            columns = [(field, index) for field, index in _canonical_columns(header).items() if index is not None]
+            for row in reader:
+                if not row:
+                    continue
+                yield reader.line_num, {field: row[index] if index < len(row) and row[index] != '' else None
+                                        for field, index in columns}
+        elif file_format == 'jsonl':
+            for line_number, line in enumerate(fp, start=1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError as error:
+                        record = error
+                    yield line_number, self._json_record(record)
+        else:
+            first = fp.read(1)
+            while first and first.isspace():
+                first = fp.read(1)
+            if first == '{':
+                # Legacy export: {coin_id: {...}} or {coin_id: [{...}, ...]}, small enough to load whole
+                data = json.loads(first + fp.read())
+                row_number = 0
+                for coin_id, details in data.items():
+                    for entry in details if isinstance(details, list) else [details]:
+                        row_number += 1
+                        # Anything but an object is passed on for _validate to reject
+                        if isinstance(entry, dict):
+                            entry = dict(entry, coin_id=coin_id)
+                        yield row_number, self._json_record(entry)
+            else:
+                fp.seek(0)
+                for row_number, record in enumerate(iter_json_array(fp), start=1):
+                    yield row_number, self._json_record(record)
+
+    @staticmethod
+    def _json_record(record):
+        # JSON rows can use any key names, so map them individually
+        if isinstance(record, dict):
+            return _canonical_record(record)
+        return record
+
+    def _resolve_coin_id(self, value, is_id):
+        """
+        Map a coin id or exchange ticker to a coin id; raises ValueError if a ticker has no single match.
+
+        Ids (`is_id`, or values shaped like CoinGecko ids) missing from crypto_lookup are kept as
+        they are with a warning, since the coin list may simply not have been synced yet.
+        """
+        key = str(value).strip().lower()
+        is_id = is_id or bool(CANONICAL_COIN_ID.fullmatch(key))
+        if (key, is_id) not in self._coin_id_cache:
+            # (coin_id, None) or (None, error message), so repeated tickers cost one lookup
+            matches = self._listed_coin_ids(key)
+            if len(matches) == 1:
+                resolved = (matches[0], None)
+            elif matches:
+                listed = ', '.join(matches[:MAX_LISTED_MATCHES]) + (', ...' if len(matches) > MAX_LISTED_MATCHES else '')
+                resolved = (None, f"ambiguous ticker '{key}', matches {listed}")
+            elif is_id:
+                resolved = (key, None)
+                self._warnings.append(f"coin '{key}' is not in the coin list; imported as given")
+            else:
+                resolved = (None, f"unknown coin '{key}'")
+            self._coin_id_cache[(key, is_id)] = resolved
+        coin_id, error = self._coin_id_cache[(key, is_id)]
+        if error:
+            raise ValueError(error)
+        return coin_id
+
+    def _listed_coin_ids(self, key):
+        self.cursor.execute('''SELECT 1 FROM crypto_lookup WHERE coin_id = ?''', (key,))
+        if self.cursor.fetchone() is not None:
+            return [key]
+        # Exchange exports use tickers; map them when the ticker belongs to exactly one listed coin
+        self.cursor.execute('''SELECT coin_id FROM crypto_lookup WHERE symbol = ? ORDER BY coin_id LIMIT ?''',
+                            (key, MAX_LISTED_MATCHES + 1))
+        return [coin_id for coin_id, in self.cursor.fetchall()]
+
+    def _validate(self, record):
+        if isinstance(record, Exception):
+            raise ValueError(f"invalid JSON: {record}")
+        if not isinstance(record, dict):
+            raise ValueError("row is not an object")
+        self._warnings = []
+
+        if record.get('coin_id') is not None:
+            coin_id = self._resolve_coin_id(record['coin_id'], is_id=True)
+        elif record.get('symbol') is not None:
+            coin_id = self._resolve_coin_id(record['symbol'], is_id=False)
+        else:
+            raise ValueError("missing coin_id")
+
+        amount_value = record.get('amount')
+        if amount_value is None:
+            raise ValueError("missing amount")
+        amount = _number(amount_value, 'amount')
+        price_value = record.get('price_per_coin')
+        price_per_coin = _number(price_value, 'price_per_coin') if price_value is not None else 0.0
+        if price_per_coin < 0:
+            raise ValueError(f"negative price_per_coin {price_per_coin}")
+        date = normalize_date(record.get('date'))
+
+        transaction_type = str(record.get('transaction_type') or 'buy').strip().lower()
+        if transaction_type not in ('buy', 'sell'):
+            raise ValueError(f"unsupported transaction_type '{transaction_type}'")
+        if amount == 0:
+            raise ValueError("amount is zero")
+
+        amount = -abs(amount) if transaction_type == 'sell' else abs(amount)
+        return (self.portfolio_id, coin_id, amount, price_per_coin, date, transaction_type)
+
+    @staticmethod
+    def _apply_holding(row, holdings):
+        """
+        Add the row to `holdings` and return True, or return False for a sell the holding does not cover.
+        """
+        coin_id, amount = row[1], row[2]
+        holding = holdings.get(coin_id, 0)
+        if amount < 0 and holding < -amount:
+            return False
+        holdings[coin_id] = holding + amount
+        return True
+
+    @timed('write_batch')
+    def _write_batch(self, batch):
+        deltas = {}
+        first_dates = {}
+        for portfolio_id, coin_id, amount, price_per_coin, date, transaction_type in batch:
+            delta = deltas.setdefault(coin_id, [0.0, 0.0, 0])
+            delta[0] += amount
+            delta[1] += amount * price_per_coin
+            delta[2] += 1
+            if coin_id not in first_dates or date < first_dates[coin_id]:
+                first_dates[coin_id] = date
+        self.cursor.executemany('''INSERT OR IGNORE INTO coins (coin_id) VALUES (?)''',
+                                [(coin_id,) for coin_id in deltas])
+        self.cursor.executemany(INSERT_TRANSACTION, batch)
+        self.cursor.executemany(APPLY_POSITION_DELTA,
+                                [(self.portfolio_id, coin_id, amount, cost, count)
+                                 for coin_id, (amount, cost, count) in deltas.items()])
+        # Imported history is usually backdated, so drop ledger checkpoints from its earliest date
+        for coin_id, date in first_dates.items():
+            invalidate_checkpoints(self.cursor, self.portfolio_id, coin_id, date)
+
+
+EXPORT_FIELDS = ('coin_id', 'amount', 'price_per_coin', 'date', 'transaction_type')
+
+
+def export_transactions(conn, portfolio_id, fp, file_format='json'):
+    """
+    Stream a portfolio's transactions to `fp` in a format import_file reads back. Returns the row count.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported export format '{file_format}'")
+    cursor = conn.cursor()
+    cursor.execute('''SELECT coin_id, abs(amount), price_per_coin, date, transaction_type FROM transactions
+                      WHERE portfolio_id = ? ORDER BY date, id''', (portfolio_id,))
+    count = 0
+    if file_format == 'csv':
+        writer = csv.writer(fp)
+        writer.writerow(EXPORT_FIELDS)
+        for row in cursor:
+            writer.writerow(row)
+            count += 1
+    elif file_format == 'jsonl':
+        for row in cursor:
+            fp.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n')
+            count += 1
+    else:
+        fp.write('[')
+        for row in cursor:
+            fp.write((',\n' if count else '\n') + json.dumps(dict(zip(EXPORT_FIELDS, row))))
+            count += 1
+        fp.write('\n]\n')
+    return count
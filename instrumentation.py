@@ -0,0 +1,304 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+# Prefix of every metric name in the Prometheus output
+METRIC_PREFIX = 'portfolio_'
+
+
+class Metrics:
+    """
+    Process-wide counters, timers and gauges, each keyed by a name and a set of labels.
+
+    Timers keep a count, a total and a maximum, which is what the --profile breakdown and the
+    Prometheus summary (_count/_sum) need. Everything is thread-safe and cheap enough to leave on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+            self.gauges = {}
+            self.started = time.time()
+            self.started_monotonic = time.perf_counter()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """
+        Return every metric as plain data, the format of the JSON metrics file.
+        """
+        with self.lock:
+            return {
+                'started': self.started,
+                'generated': time.time(),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'timers': [{'name': name, 'labels': dict(labels), 'count': count, 'total_seconds': total,
+                            'max_seconds': maximum}
+                           for (name, labels), (count, total, maximum) in sorted(self.timers.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+            }
+
+    def to_prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        families = set()
+
+        def declare(name, metric_type):
+            if name not in families:
+                families.add(name)
+                lines.append(f'# TYPE {METRIC_PREFIX}{name} {metric_type}')
+
+        for counter in snapshot['counters']:
+            declare(counter['name'], 'counter')
+            lines.append(_sample(counter['name'], counter['labels'], counter['value']))
+        for timer in snapshot['timers']:
+            declare(timer['name'], 'summary')
+            lines.append(_sample(timer['name'] + '_count', timer['labels'], timer['count']))
+            lines.append(_sample(timer['name'] + '_sum', timer['labels'], timer['total_seconds']))
+        for timer in snapshot['timers']:
+            declare(timer['name'] + '_max', 'gauge')
+            lines.append(_sample(timer['name'] + '_max', timer['labels'], timer['max_seconds']))
+        for gauge in snapshot['gauges']:
+            declare(gauge['name'], 'gauge')
+            lines.append(_sample(gauge['name'], gauge['labels'], gauge['value']))
+        declare('metrics_start_time_seconds', 'gauge')
+        lines.append(_sample('metrics_start_time_seconds', {}, snapshot['started']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write the metrics to `path`: JSON if it ends in .json, else Prometheus text (for the
+        node_exporter textfile collector). The file is replaced atomically so scrapers never see half of it.
+        """
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.to_prometheus()
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temporary_path, path)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    label_text = ','.join(f'{key}="{_escape_label(label)}"' for key, label in sorted(labels.items()))
+    name = METRIC_PREFIX + name
+    return f'{name}{{{label_text}}} {value!r}' if label_text else f'{name} {value!r}'
+
+
+metrics = Metrics()
+_phases = threading.local()
+
+
+@contextmanager
+def phase(name):
+    """
+    Time one step of an operation as operation_seconds{operation=...}.
+
+    Phases nest per thread, so a `fetch` phase inside `update_prices` is recorded as update_prices/fetch.
+    """
+    stack = getattr(_phases, 'stack', None)
+    if stack is None:
+        stack = _phases.stack = []
+    stack.append(name)
+    path = '/'.join(stack)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stack.pop()
+        metrics.observe('operation_seconds', time.perf_counter() - started, operation=path)
+
+
+def timed(name):
+    """
+    Decorator form of phase().
+    """
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@lru_cache(maxsize=512)
+def statement_kind(sql):
+    words = sql.split(None, 1)
+    return words[0].lower() if words else 'empty'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that times execute, executemany and fetch calls as sql_seconds{kind=select|insert|...}.
+
+    SQLite does most of a query's work while rows are fetched, so fetches count towards the
+    statement that produced them. Rows read by iterating the cursor directly are not timed.
+    """
+
+    kind = 'unknown'
+
+    def execute(self, sql, parameters=()):
+        self.kind = statement_kind(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe('sql_seconds', time.perf_counter() - started, kind=self.kind)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.kind = statement_kind(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe('sql_seconds', time.perf_counter() - started, kind=self.kind)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.count('sql_fetch_seconds_total', time.perf_counter() - started, kind=self.kind)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            metrics.count('sql_fetch_seconds_total', time.perf_counter() - started, kind=self.kind)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.count('sql_fetch_seconds_total', time.perf_counter() - started, kind=self.kind)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are InstrumentedCursors and whose commits are timed.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts bypass cursor(), so route them through it
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with metrics.timer('sql_commit_seconds'):
+            super().commit()
+
+    def rollback(self):
+        if self.in_transaction:
+            metrics.count('sql_rollbacks_total')
+        super().rollback()
+
+
+def format_profile(snapshot=None):
+    """
+    Render a per-phase breakdown of `snapshot` (default: the current metrics) for --profile.
+    """
+    snapshot = snapshot or metrics.snapshot()
+    timers = {}
+    for timer in snapshot['timers']:
+        timers.setdefault(timer['name'], []).append(timer)
+    counters = {}
+    for counter in snapshot['counters']:
+        counters.setdefault(counter['name'], []).append(counter)
+
+    def total(name, **labels):
+        return sum(counter['value'] for counter in counters.get(name, [])
+                   if all(counter['labels'].get(key) == value for key, value in labels.items()))
+
+    lines = [f"Profile: {snapshot['generated'] - snapshot['started']:.3f} s since start",
+             f"{'operation':<48} {'calls':>7} {'total ms':>11} {'max ms':>10}"]
+    for timer in sorted(timers.get('operation_seconds', []), key=lambda timer: timer['labels']['operation']):
+        path = timer['labels']['operation'].split('/')
+        label = '  ' * (len(path) - 1) + path[-1]
+        lines.append(f"{label:<48} {timer['count']:>7} {timer['total_seconds'] * 1000:>11.1f} "
+                     f"{timer['max_seconds'] * 1000:>10.1f}")
+
+    http = timers.get('http_request_seconds', [])
+    if http:
+        lines.append(f"{'HTTP (time summed over concurrent requests)':<48} {'calls':>7} {'total ms':>11} {'KB':>10}")
+        for timer in http:
+            labels = timer['labels']
+            received = total('http_response_bytes_total', api=labels['api'], endpoint=labels['endpoint'],
+                             status=labels['status'])
+            label = f"{labels['api']} {labels['endpoint']} {labels['status']}"
+            lines.append(f"  {label:<46} {timer['count']:>7} {timer['total_seconds'] * 1000:>11.1f} "
+                         f"{received / 1024:>10.1f}")
+        decode = sum(timer['total_seconds'] for timer in timers.get('json_decode_seconds', []))
+        lines.append(f"  retries {total('http_retries_total'):g}, rate limited (429) "
+                     f"{total('http_rate_limited_total'):g}, waiting for the rate limit "
+                     f"{total('rate_limit_wait_seconds_total') * 1000:.1f} ms, JSON decoding {decode * 1000:.1f} ms")
+
+    sql = timers.get('sql_seconds', [])
+    if sql:
+        lines.append(f"{'SQLite':<48} {'calls':>7} {'total ms':>11} {'max ms':>10}")
+        for timer in sorted(sql, key=lambda timer: -timer['total_seconds']):
+            kind = timer['labels']['kind']
+            fetch = total('sql_fetch_seconds_total', kind=kind)
+            lines.append(f"  {kind:<46} {timer['count']:>7} {(timer['total_seconds'] + fetch) * 1000:>11.1f} "
+                         f"{timer['max_seconds'] * 1000:>10.1f}")
+        for timer in timers.get('sql_commit_seconds', []):
+            lines.append(f"  {'commit':<46} {timer['count']:>7} {timer['total_seconds'] * 1000:>11.1f} "
+                         f"{timer['max_seconds'] * 1000:>10.1f}")
+    return '\n'.join(lines)
@@ -0,0 +1,166 @@
+import os
+from array import array
+from collections import deque
+from itertools import chain
+
+from sql_queries import (
+    DELETE_INTERIM_LEDGER_CHECKPOINTS,
+    DELETE_LEDGER_CHECKPOINTS,
+    INSERT_LEDGER_CHECKPOINT,
+    INVALIDATE_LEDGER_CHECKPOINTS,
+    SELECT_LATEST_LEDGER_CHECKPOINT,
+    SELECT_LEDGER_CHECKPOINT_LOTS,
+    SELECT_LEDGER_COINS,
+    SELECT_LEDGER_TRANSACTIONS,
+)
+
+METHODS = ('fifo', 'lifo', 'average')
+DEFAULT_METHOD = 'fifo'
+# A checkpoint is kept every this many transactions, so an edit replays at most this many plus the tail
+CHECKPOINT_INTERVAL = 10000
+# Lots and positions smaller than this count as fully sold
+DUST = 1e-12
+
+
+class LotBook:
+    """
+    Open lots, cost basis and realized P&L for one coin under one accounting method.
+
+    FIFO and LIFO keep [amount, price] lots, oldest first; average cost only needs the totals.
+    """
+
+    def __init__(self, method, amount=0.0, cost_basis=0.0, realized_pnl=0.0, lots=None):
+        self.method = method
+        self.amount = amount
+        self.cost_basis = cost_basis
+        self.realized_pnl = realized_pnl
+        self.lots = lots if lots is not None else deque()
+
+    def buy(self, amount, price):
+        self.amount += amount
+        self.cost_basis += amount * price
+        if self.method != 'average':
+            self.lots.append([amount, price])
+
+    def sell(self, amount, price):
+        if self.method == 'average':
+            sold_cost = self.cost_basis * min(1.0, amount / self.amount) if self.amount > DUST else 0.0
+        else:
+            sold_cost = 0.0
+            remaining = amount
+            index = 0 if self.method == 'fifo' else -1
+            while remaining > DUST and self.lots:
+                lot = self.lots[index]
+                used = min(lot[0], remaining)
+                sold_cost += used * lot[1]
+                remaining -= used
+                lot[0] -= used
+                if lot[0] <= DUST:
+                    if index == 0:
+                        self.lots.popleft()
+                    else:
+                        self.lots.pop()
+            # Anything sold beyond the open lots has no recorded cost
+        self.amount -= amount
+        self.cost_basis -= sold_cost
+        self.realized_pnl += amount * price - sold_cost
+        if abs(self.amount) <= DUST and not self.lots:
+            self.amount = 0.0
+            self.cost_basis = 0.0
+
+    def apply(self, amount, price, transaction_type):
+        # Sells are stored with negative amounts; edits may leave either sign, so trust both fields
+        if amount < 0 or transaction_type == 'sell':
+            self.sell(abs(amount), price)
+        else:
+            self.buy(amount, price)
+
+    def pack_lots(self):
+        return array('d', chain.from_iterable(self.lots)).tobytes()
+
+    @staticmethod
+    def unpack_lots(blob):
+        flat = array('d')
+        flat.frombytes(blob or b'')
+        return deque([flat[i], flat[i + 1]] for i in range(0, len(flat), 2))
+
+
+class Ledger:
+    """
+    Cost basis and realized P&L per coin, replayed incrementally from checkpoints.
+
+    The latest checkpoint per (portfolio, coin, method) lets new transactions be applied without
+    replaying the ledger, and one checkpoint is kept every CHECKPOINT_INTERVAL transactions so a
+    backdated add or an edit (see invalidate_checkpoints) only replays from the affected date.
+    Replays write checkpoints through `cursor` and the caller commits, unless `save_checkpoints`
+    is false: then existing checkpoints are only read, for callers that must not write.
+    """
+
+    def __init__(self, cursor, method=None, save_checkpoints=True):
+        self.cursor = cursor
+        self.save_checkpoints = save_checkpoints
+        self.method = (method or os.getenv("LEDGER_METHOD") or DEFAULT_METHOD).lower()
+        if self.method not in METHODS:
+            raise ValueError(f"Unknown cost basis method '{self.method}'")
+
+    def portfolio_summary(self, portfolio_id):
+        """
+        Return {coin_id: summary} for every coin the portfolio ever traded; see coin_summary.
+        """
+        self.cursor.execute(SELECT_LEDGER_COINS, (portfolio_id,))
+        coin_ids = [coin_id for coin_id, in self.cursor.fetchall()]
+        return {coin_id: self.coin_summary(portfolio_id, coin_id) for coin_id in coin_ids}
+
+    def coin_summary(self, portfolio_id, coin_id):
+        """
+        Return {'amount', 'cost_basis', 'average_cost', 'realized_pnl'} for one coin.
+        """
+        key = {'portfolio_id': portfolio_id, 'coin_id': coin_id, 'method': self.method}
+        self.cursor.execute(SELECT_LATEST_LEDGER_CHECKPOINT, key)
+        checkpoint = self.cursor.fetchone()
+        seq, last_date, last_id, amount, cost_basis, realized_pnl = checkpoint or (0, None, None, 0.0, 0.0, 0.0)
+
+        self.cursor.execute(SELECT_LEDGER_TRANSACTIONS, dict(key, last_date=last_date, last_id=last_id))
+        transactions = self.cursor.fetchall()
+        if not transactions:
+            return self._summary(amount, cost_basis, realized_pnl)
+
+        lots = None
+        if checkpoint and self.method != 'average':
+            self.cursor.execute(SELECT_LEDGER_CHECKPOINT_LOTS, dict(key, seq=seq))
+            lots = LotBook.unpack_lots(self.cursor.fetchone()[0])
+        book = LotBook(self.method, amount, cost_basis, realized_pnl, lots)
+
+        if self.save_checkpoints:
+            self.cursor.execute(DELETE_INTERIM_LEDGER_CHECKPOINTS, dict(key, interval=CHECKPOINT_INTERVAL))
+        for transaction_id, amount, price_per_coin, date, transaction_type in transactions:
+            book.apply(amount, price_per_coin or 0.0, transaction_type)
+            seq += 1
+            if self.save_checkpoints and (seq % CHECKPOINT_INTERVAL == 0 or transaction_id == transactions[-1][0]):
+                self.cursor.execute(INSERT_LEDGER_CHECKPOINT, dict(
+                    key, seq=seq, last_date=date, last_id=transaction_id, amount=book.amount,
+                    cost_basis=book.cost_basis, realized_pnl=book.realized_pnl, lots=book.pack_lots()))
+        return self._summary(book.amount, book.cost_basis, book.realized_pnl)
+
+    @staticmethod
+    def _summary(amount, cost_basis, realized_pnl):
+        return {
+            'amount': amount,
+            'cost_basis': cost_basis,
+            'average_cost': cost_basis / amount if amount > DUST else 0.0,
+            'realized_pnl': realized_pnl,
+        }
+
+
+def invalidate_checkpoints(cursor, portfolio_id, coin_id, since):
+    """
+    Drop checkpoints that a transaction added or edited at date `since` makes stale.
+    """
+    cursor.execute(INVALIDATE_LEDGER_CHECKPOINTS, {'portfolio_id': portfolio_id, 'coin_id': coin_id, 'since': since})
+
+
+def reset_checkpoints(cursor, portfolio_id=None):
+    """
+    Drop all checkpoints, for one portfolio or all of them, so the next summary replays from scratch.
+    """
+    cursor.execute(DELETE_LEDGER_CHECKPOINTS, {'portfolio_id': portfolio_id})
@@ -1,43 +1,71 @@
-import requests
-import sqlite3
+import argparse
 import json
+import sys
+from collections.abc import Mapping
+from contextlib import redirect_stdout
 from datetime import datetime
-import time
 import os
-from dotenv import load_dotenv
-import webbrowser
+from database import (
+    compact_database,
+    get_connection,
+    migrate,
+    rebuild_positions,
+    transaction,
+)
+from history import query_history, record_snapshot
+from instrumentation import format_profile, metrics, phase, timed
+from ledger import Ledger, invalidate_checkpoints, reset_checkpoints
+from prices import (
+    market_to_coin_data,
+    portfolio_value,
+    refresh_all_prices,
+    store_coin_data,
+)
 from sql_queries import (
-    CREATE_PORTFOLIOS_TABLE,
-    CREATE_TRANSACTIONS_TABLE,
-    CREATE_COINS_TABLE,
-    CREATE_CRYPTOLOOKUP_TABLE,
-    CREATE_HISTORY_TABLE,
+    APPLY_POSITION_DELTA,
+    INSERT_TRANSACTION,
+    SELECT_POSITIONS,
+    SEARCH_COINS,
+    SEARCH_COINS_SHORT,
 )
 
-load_dotenv()
-
 
 class CoinGeckoPortfolioManager:
-    def __init__(self, portfolio_id, name, currency='usd'):
+    def __init__(self, portfolio_id, name, currency='usd', fetcher=None, conn=None, providers=None):
         self.portfolio_id = portfolio_id
         self.name = name
         self.portfolio = {}
         self.currency = currency.lower()
-        self.conn = sqlite3.connect('portfolio.db')
+        self._fetcher = fetcher
+        self._providers = providers
+        # Full API payloads are only kept in coins.coin_data when explicitly requested
+        self.store_raw_payloads = os.getenv("STORE_RAW_PAYLOADS", "").lower() in ('1', 'true', 'yes')
+        # All managers share one connection; the schema is migrated once when it is opened
+        self.conn = conn or get_connection()
         self.cursor = self.conn.cursor()
-        self.create_tables()
+
+    @property
+    def fetcher(self):
+        # Importing the fetcher pulls in requests, so wait until prices are actually needed
+        if self._fetcher is None:
+            from fetcher import get_default_fetcher
+            self._fetcher = get_default_fetcher()
+        return self._fetcher
+
+    @fetcher.setter
+    def fetcher(self, fetcher):
+        self._fetcher = fetcher
+
+    @property
+    def providers(self):
+        if self._providers is None:
+            from providers import build_providers, get_default_providers
+            # A fetcher passed in explicitly (e.g. pointed at a test server) gets its own chain
+            self._providers = build_providers(self._fetcher) if self._fetcher else get_default_providers()
+        return self._providers
 
     def create_tables(self):
-        tables = [
-            CREATE_PORTFOLIOS_TABLE,
-            CREATE_TRANSACTIONS_TABLE,
-            CREATE_COINS_TABLE,
-            CREATE_CRYPTOLOOKUP_TABLE,
-            CREATE_HISTORY_TABLE,
-        ]
-        for table_query in tables:
-            self.cursor.execute(table_query)
-        self.conn.commit()
+        migrate(self.conn)
 
     def load_transactions(self):
         self.cursor.execute('''SELECT coin_id, amount, price_per_coin FROM transactions WHERE portfolio_id = ?''',
@@ -46,34 +74,30 @@ class CoinGeckoPortfolioManager:
         for coin_id, amount, price_per_coin in transactions:
             self.portfolio[coin_id] = {'amount': amount, 'price': price_per_coin}
 
-    def add_transaction(self, coin_id, amount, price_per_coin, date, transaction_type='buy'):
+    def get_positions(self, coin_id=None):
+        """
+        Return {coin_id: amount} read from the positions table.
+        """
+        self.cursor.execute(SELECT_POSITIONS, {'portfolio_id': self.portfolio_id, 'coin_id': coin_id})
+        return dict(self.cursor.fetchall())
 
-        self.load_transactions()
+    def add_transaction(self, coin_id, amount, price_per_coin, date, transaction_type='buy'):
 
         if transaction_type.lower() == 'sell':
-            current_holding = 0
-
-            self.cursor.execute('''SELECT amount FROM transactions WHERE portfolio_id = ? AND coin_id = ?''',
-                                (self.portfolio_id, coin_id))
-            transactions = self.cursor.fetchall()
-            for transaction in transactions:
-                current_holding += transaction[0]
+            current_holding = self.get_positions(coin_id).get(coin_id, 0)
 
             if current_holding < abs(amount):
                 print("Error: Insufficient holding to sell.")
                 return
             amount = -abs(amount)
 
-        self.cursor.execute('''SELECT coin_id FROM coins WHERE coin_id = ?''', (coin_id,))
-        existing_coin = self.cursor.fetchone()
-
-        if not existing_coin:
-            self.cursor.execute('''INSERT INTO coins (coin_id) VALUES (?)''', (coin_id,))
-
-        self.cursor.execute('''INSERT INTO transactions (portfolio_id, coin_id, amount, price_per_coin, date, transaction_type) 
-                            VALUES (?, ?, ?, ?, ?, ?)''',
-                            (self.portfolio_id, coin_id, amount, price_per_coin, date, transaction_type))
-        self.conn.commit()
+        with transaction(self.conn) as cursor:
+            cursor.execute('''INSERT OR IGNORE INTO coins (coin_id) VALUES (?)''', (coin_id,))
+            cursor.execute(INSERT_TRANSACTION,
+                           (self.portfolio_id, coin_id, amount, price_per_coin, date, transaction_type))
+            cursor.execute(APPLY_POSITION_DELTA,
+                           (self.portfolio_id, coin_id, amount, amount * price_per_coin, 1))
+            invalidate_checkpoints(cursor, self.portfolio_id, coin_id, date)
         print(
             f"Transaction added to {self.name}: {transaction_type} {amount} {coin_id} on {date} at price {price_per_coin} {self.currency}")
 
@@ -116,11 +140,15 @@ class CoinGeckoPortfolioManager:
                     new_amount = float(input("Enter new amount: "))
                     new_price_per_coin = float(input(f"Enter new price per coin ({price_per_coin}): ") or price_per_coin)
                     new_date = input(f"Enter new date ({date}): ") or date
-                    self.cursor.execute('''UPDATE transactions 
-                                        SET amount = ?, price_per_coin = ?, date = ? 
-                                        WHERE id = ?''',
-                                        (new_amount, new_price_per_coin, new_date, transaction_id))
-                    self.conn.commit()
+                    with transaction(self.conn) as cursor:
+                        cursor.execute('''UPDATE transactions 
+                                          SET amount = ?, price_per_coin = ?, date = ? 
+                                          WHERE id = ?''',
+                                       (new_amount, new_price_per_coin, new_date, transaction_id))
+                        cursor.execute(APPLY_POSITION_DELTA,
+                                       (self.portfolio_id, coin_id, new_amount - amount,
+                                        new_amount * new_price_per_coin - amount * price_per_coin, 0))
+                        invalidate_checkpoints(cursor, self.portfolio_id, coin_id, min(date, new_date))
                     print("Transaction edited successfully.")
                     break
                 else:
@@ -128,170 +156,259 @@ class CoinGeckoPortfolioManager:
             except ValueError:
                 print("Invalid input. Please enter a valid number.")
 
-    def update_prices(self):
-        self.load_transactions()
-        all_prices_fetched = True
-        for coin_id in self.portfolio.keys():
-            url = f"https://api.coingecko.com/api/v3/coins/{coin_id}?localization=false&tickers=false&market_data=true&community_data=false&developer_data=false&sparkline=false"
-            response = requests.get(url)
-            if response.status_code == 200:
-                coin_data = response.json()
-                last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cursor.execute(
-                    '''INSERT OR REPLACE INTO coins (coin_id, coin_data, last_updated) VALUES (?, ?, ?)''',
-                    (coin_id, json.dumps(coin_data), last_updated))
-                self.conn.commit()
+    @timed('update_prices')
+    def update_prices(self, batched=True):
+        # Fully sold coins need no price, and a delisted one would block the history snapshot
+        coin_ids = [coin_id for coin_id, amount in self.get_positions().items() if amount != 0]
+        # Fetch everything before writing so the write lock is never held across network calls
+        with phase('fetch'):
+            if batched:
+                fetched = self._fetch_prices_batched(coin_ids)
             else:
-                headers = {"x-cg-demo-api-key": os.getenv("API_KEY")}
-                response_with_key = requests.get(url, headers=headers)
-                if response_with_key.status_code == 200:
-                    coin_data = response_with_key.json()
-                    last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.cursor.execute(
-                        '''INSERT OR REPLACE INTO coins (coin_id, coin_data, last_updated) VALUES (?, ?, ?)''',
-                        (coin_id, json.dumps(coin_data), last_updated))
-                    self.conn.commit()
+                fetched = self._fetch_prices_per_coin(coin_ids)
+                # Coins /coins/{id} could not price are filled in from the markets endpoint or another provider
+                missing = [coin_id for coin_id in coin_ids if coin_id not in fetched]
+                if missing:
+                    fetched.update(self._fetch_prices_batched(missing))
+        last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        all_prices_fetched = True
+        with phase('write'), transaction(self.conn) as cursor:
+            self.providers.save(cursor)
+            for coin_id in coin_ids:
+                if coin_id in fetched:
+                    coin_data, raw_payload = fetched[coin_id]
+                    store_coin_data(cursor, coin_id, coin_data, last_updated, raw_payload, self.store_raw_payloads)
                 else:
                     print(f"Failed to update data for {coin_id}. Please try again later.")
                     all_prices_fetched = False
 
-        # Store into history table only if prices for all coins were successfully fetched
-        if all_prices_fetched:
-            time.sleep(1) 
-            portfolio_data = self.get_portfolio_value()
-            portfolio_id = self.portfolio_id
-            date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.cursor.execute(
-                '''INSERT INTO history (portfolio_id, portfolio_data, last_updated) VALUES (?, ?, ?)''',
-                (portfolio_id, json.dumps(portfolio_data), date))
-            self.conn.commit()
-        else:
-            print("Not storing into history table because prices for all coins were not fetched successfully.")
+            # Store into history only if prices for all coins were successfully fetched
+            if all_prices_fetched:
+                self.record_history_snapshot(last_updated)
+            else:
+                print("Not storing into history table because prices for all coins were not fetched successfully.")
+        return all_prices_fetched
 
-    def get_portfolio_value(self):
-        self.load_transactions()
-        portfolio_data = {'coins': {}}
-
-        for coin_id, coin_data in self.portfolio.items():
-            amount = 0
-            self.cursor.execute('''SELECT amount FROM transactions WHERE portfolio_id = ? AND coin_id = ?''',
-                                (self.portfolio_id, coin_id))
-            transactions = self.cursor.fetchall()
-            for transaction in transactions:
-                amount += transaction[0]
-
-            self.cursor.execute(
-                '''SELECT coin_data FROM coins WHERE coin_id = ? ORDER BY last_updated DESC LIMIT 1''', (coin_id,))
-            coin_json = self.cursor.fetchone()
-            if coin_json and coin_json[0]:
-                coin_data = json.loads(coin_json[0])
-                price = coin_data['market_data']['current_price'][self.currency]
-
-                price_change_1h = coin_data['market_data']['price_change_percentage_1h_in_currency'].get(self.currency, 0)
-                price_change_24h = coin_data['market_data']['price_change_percentage_24h_in_currency'].get(self.currency, 0)
-                price_change_7d = coin_data['market_data']['price_change_percentage_7d_in_currency'].get(self.currency, 0)
-                price_change_14d = coin_data['market_data']['price_change_percentage_14d_in_currency'].get(self.currency, 0)
-                price_change_30d = coin_data['market_data']['price_change_percentage_30d_in_currency'].get(self.currency, 0)
-                price_change_60d = coin_data['market_data']['price_change_percentage_60d_in_currency'].get(self.currency, 0)
-                price_change_200d = coin_data['market_data']['price_change_percentage_200d_in_currency'].get(self.currency, 0)
-                price_change_1y = coin_data['market_data']['price_change_percentage_1y_in_currency'].get(self.currency, 0)
-
-                portfolio_data['coins'][coin_id] = {'amount': amount, 'price': price, 'price_change_1h': price_change_1h, 'price_change_24h': price_change_24h, 'price_change_7d': price_change_7d, 'price_change_14d': price_change_14d, 'price_change_30d': price_change_30d, 'price_change_60d': price_change_60d, 'price_change_200d': price_change_200d, 'price_change_1y': price_change_1y}
-
-        return portfolio_data
+    def _fetch_prices_per_coin(self, coin_ids):
+        """
+        Fetch /coins/{id} for each coin; returns {coin_id: (coin_data, raw_payload)} for the coins that succeeded.
+        """
+        params = {'localization': 'false', 'tickers': 'false', 'market_data': 'true',
+                  'community_data': 'false', 'developer_data': 'false', 'sparkline': 'false'}
+        results = self.fetcher.map(lambda coin_id: self.fetcher.get_json(f"coins/{coin_id}", params), coin_ids)
+        return {coin_id: (coin_data, None) for coin_id, coin_data in zip(coin_ids, results) if coin_data is not None}
+
+    def _fetch_prices_batched(self, coin_ids):
+        """
+        Fetch prices for many coins per request using /coins/markets, falling back to the other price providers.
+        """
+        markets = self.providers.fetch_market_prices(self.cursor, {self.currency: coin_ids})[self.currency]
+        return {coin_id: (market_to_coin_data(market, self.currency), market) for coin_id, market in markets.items()}
+
+    @timed('get_portfolio_value')
+    def get_portfolio_value(self, currency=None):
+        """
+        Value the portfolio from stored prices in `currency` (default: the portfolio's own), without fetching.
+        """
+        return portfolio_value(self.cursor, (currency or self.currency).lower(), self.portfolio_id)
     
-    def get_portfolio_history(self):
-        historic_portfolio_data = {'data': {}}
-        
-        # Retrieve historical data for the portfolio from the history table
-        self.cursor.execute('''SELECT portfolio_data, last_updated FROM history WHERE portfolio_id = ? ORDER BY last_updated DESC''', (self.portfolio_id,))
-        history_entries = self.cursor.fetchall()
-        
-        # Check if historical data exists
-        if history_entries:
-            for idx, entry in enumerate(history_entries, start=1):
-                portfolio_data_json, last_updated = entry
-                portfolio_data = json.loads(portfolio_data_json)
-                historic_portfolio_data['data'][idx] = {
-                    'portfolio_data': portfolio_data,
-                    'last_updated': last_updated
-                }
-        else:
+    def record_history_snapshot(self, date=None):
+        """
+        Store the current positions and prices as a history snapshot; the caller commits.
+        """
+        date = date or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        coins = {coin_id: (details['amount'], details['price'])
+                 for coin_id, details in self.get_portfolio_value()['coins'].items()}
+        return record_snapshot(self.cursor, self.portfolio_id, date, coins)
+
+    @timed('get_portfolio_history')
+    def get_portfolio_history(self, start=None, end=None, resolution=None):
+        """
+        Return the portfolio's total value over time, oldest first.
+
+        `resolution` is one of raw, hour, day or week; by default it is chosen from the range.
+        """
+        resolution, points = query_history(self.cursor, self.portfolio_id, start, end, resolution)
+        if not points:
             print("No historical data found for this portfolio.")
+        return {
+            'resolution': resolution,
+            'data': [{'last_updated': ts, 'total_value': total_value} for ts, total_value in points],
+        }
+
+    def get_value_curve(self, start=None, end=None, interval='daily', fetch=True):
+        """
+        Reconstruct the portfolio value over time from transactions and historical prices.
 
-        return historic_portfolio_data
+        See backfill.PortfolioBackfill.value_curve for the returned arrays.
+        """
+        # NumPy is only needed here, so keep it out of startup
+        from backfill import PortfolioBackfill
+        return PortfolioBackfill(self.conn, self.fetcher).value_curve(
+            self.portfolio_id, self.currency, start, end, interval, fetch)
+
+    @timed('import_transactions')
+    def import_transactions(self, path, file_format=None):
+        """
+        Bulk import transactions from a JSON, JSONL or CSV file; see importer.BulkImporter.
+        """
+        from importer import BulkImporter
+        return BulkImporter(self.conn, self.portfolio_id).import_file(path, file_format)
+
+    @timed('get_profit_and_loss')
+    def get_profit_and_loss(self, method=None, save_checkpoints=True):
+        """
+        Return cost basis and realized/unrealized P&L per coin and in total.
+
+        `method` is fifo, lifo or average (default: LEDGER_METHOD, else fifo). Coins that were
+        sold off completely are included for their realized P&L. With `save_checkpoints` false
+        nothing is written: new transactions are replayed from the stored checkpoints every time.
+        """
+        prices = {coin_id: details['price'] for coin_id, details in self.get_portfolio_value()['coins'].items()}
+        if save_checkpoints:
+            with transaction(self.conn) as cursor:
+                ledger = Ledger(cursor, method)
+                coins = ledger.portfolio_summary(self.portfolio_id)
+        else:
+            ledger = Ledger(self.conn.cursor(), method, save_checkpoints=False)
+            coins = ledger.portfolio_summary(self.portfolio_id)
+
+        totals = {'cost_basis': 0.0, 'value': 0.0, 'realized_pnl': 0.0, 'unrealized_pnl': 0.0}
+        for coin_id, summary in coins.items():
+            price = prices.get(coin_id)
+            summary['price'] = price
+            summary['value'] = summary['amount'] * price if price is not None else None
+            summary['unrealized_pnl'] = summary['value'] - summary['cost_basis'] if price is not None else None
+            for key in totals:
+                totals[key] += summary[key] or 0.0
+        return {'method': ledger.method, 'coins': coins, 'totals': totals}
+
+    def rebuild_positions(self):
+        with transaction(self.conn) as cursor:
+            rebuild_positions(cursor, self.portfolio_id)
+            reset_checkpoints(cursor, self.portfolio_id)
 
     def delete_portfolio(self):
-        self.cursor.execute('''UPDATE portfolios SET deleted = 1 WHERE id = ?''', (self.portfolio_id,))
-        self.conn.commit()
-        self.conn.close()
+        with transaction(self.conn) as cursor:
+            cursor.execute('''UPDATE portfolios SET deleted = 1 WHERE id = ?''', (self.portfolio_id,))
+
+
+class PortfolioRegistry(Mapping):
+    """
+    Maps portfolio ids to managers, creating each manager the first time it is used.
+
+    Loading only reads the portfolios table, so startup cost does not grow with the number of portfolios.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = {}
+        self._managers = {}
+
+    def load(self):
+        cursor = self.conn.cursor()
+        cursor.execute('''SELECT id, name, currency FROM portfolios WHERE deleted = 0''')
+        self._rows = {portfolio_id: (name, currency) for portfolio_id, name, currency in cursor.fetchall()}
+        self._managers = {}
+
+    def add(self, portfolio_id, name, currency):
+        self._rows[portfolio_id] = (name, currency)
+
+    def names(self):
+        """
+        Return [(portfolio_id, name)] without creating any managers.
+        """
+        return [(portfolio_id, name) for portfolio_id, (name, currency) in self._rows.items()]
+
+    def names_by_id(self):
+        return dict(self.names())
+
+    def __getitem__(self, portfolio_id):
+        if portfolio_id not in self._managers:
+            name, currency = self._rows[portfolio_id]
+            self._managers[portfolio_id] = CoinGeckoPortfolioManager(portfolio_id, name, currency, conn=self.conn)
+        return self._managers[portfolio_id]
+
+    def __delitem__(self, portfolio_id):
+        del self._rows[portfolio_id]
+        self._managers.pop(portfolio_id, None)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
 
 
 class CoinGeckoCLI:
     def __init__(self):
-        self.portfolios = {}
-        self.conn = sqlite3.connect('portfolio.db')
+        # python-dotenv is only needed once, before anything reads the environment
+        from dotenv import load_dotenv
+        load_dotenv()
+        self.conn = get_connection()
         self.cursor = self.conn.cursor()
-        self.create_portfolio_table()
+        self.portfolios = PortfolioRegistry(self.conn)
+        self._fetcher = None
+        self._web_server = None
+        self._opened_pages = set()
         self.load_portfolios()
 
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            from fetcher import get_default_fetcher
+            self._fetcher = get_default_fetcher()
+        return self._fetcher
+
     def load_portfolios(self):
-        self.cursor.execute('''SELECT id, name, currency, deleted FROM portfolios WHERE deleted = 0''')
-        portfolios = self.cursor.fetchall()
-        for portfolio_id, name, currency, deleted in portfolios:
-            if not deleted:
-                self.create_portfolio_object(portfolio_id, name, currency)
-
-    def create_portfolio_table(self):
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS portfolios (
-                                id INTEGER PRIMARY KEY,
-                                name TEXT,
-                                currency TEXT,
-                                deleted INTEGER DEFAULT 0
-                                )''')
-        self.conn.commit()
+        self.portfolios.load()
 
     def create_portfolio_object(self, portfolio_id, name, currency):
-        self.portfolios[portfolio_id] = CoinGeckoPortfolioManager(portfolio_id, name, currency)
+        self.portfolios.add(portfolio_id, name, currency)
 
-    def refresh_coingecko_list(self):
+    def refresh_coingecko_list(self, force=False):
         print("Refreshing CoinGecko coin list...")
-        url = "https://api.coingecko.com/api/v3/coins/list"
-        headers = {"x-cg-demo-api-key": os.getenv("API_KEY")}
-        response = requests.get(url, headers = headers)
-
-        if response.status_code == 200:
-            coin_list = response.json()
-
-            # Check if the coin is already listed in the database
-            existing_coins = set()
-            self.cursor.execute("SELECT coin_id FROM crypto_lookup")
-            for row in self.cursor.fetchall():
-                existing_coins.add(row[0])
-
-            # Insert new coin data into the crypto_lookup table
-            new_coins = []
-            for coin in coin_list:
-                coin_id = coin['id']
-                if coin_id not in existing_coins:
-                    new_coins.append((coin_id, coin['symbol'], coin['name']))
-
-            if new_coins:
-                self.cursor.executemany("INSERT INTO crypto_lookup (coin_id, symbol, name) VALUES (?, ?, ?)", new_coins)
-                self.conn.commit()
-                print(f"{len(new_coins)} new coins added.")
-            else:
-                print("No new coins found.")
+        from coinlist import sync_coin_list
+        report = sync_coin_list(self.conn, self.fetcher, force)
+        if report is None:
+            print("Failed to refresh CoinGecko coin list. Please try again later.")
+            return False
 
-            print("CoinGecko coin list refreshed successfully.")
+        if report['status'] == 'not_modified':
+            print("Coin list not modified since the last refresh.")
+        elif report['status'] == 'unchanged':
+            print(f"Coin list unchanged ({report['coins']} coins).")
         else:
-            print("Failed to refresh CoinGecko coin list. Please try again later.")
+            print(f"{report['coins']} coins listed: {report['added']} new, {report['changed']} updated, "
+                  f"{report['delisted']} delisted.")
+            if report['delisting_skipped']:
+                print("Too many coins are missing from the downloaded list; not marking any as delisted. "
+                      "Use --force from the command line to apply it anyway.")
+        print("CoinGecko coin list refreshed successfully.")
+        return True
+
+    def rebuild_positions(self):
+        print("Rebuilding positions from transactions...")
+        with transaction(self.conn) as cursor:
+            rebuild_positions(cursor)
+            reset_checkpoints(cursor)
+        print("Positions rebuilt successfully.")
+
+    def compact_database(self):
+        print("Compacting database...")
+        compact_database(self.conn)
+        print("Database compacted successfully.")
 
     def menu(self):
         print("\n===== CoinGecko Portfolio Manager =====")
         print("1. Create Portfolio")
         print("2. Manage Portfolios")
         print("3. Refresh Coins list")
+        print("4. Rebuild Positions")
+        print("5. Compact Database")
+        print("6. Update Prices (All Portfolios)")
+        print("7. View All Portfolios")
         print("0. Exit")
 
     def manage_portfolios_menu(self):
@@ -302,42 +419,67 @@ class CoinGeckoCLI:
         print("4. Import Portfolio")
         print("5. Modify Transactions")
         print("6. Delete Portfolio")
+        print("7. Reconstruct Value History")
+        print("8. View Profit and Loss")
         print("0. Back")
 
     def create_portfolio(self):
         name = input("Enter portfolio name: ")
         currency = input("Enter currency (default: usd): ").lower() or 'usd'
-        self.cursor.execute('''INSERT INTO portfolios (name, currency) VALUES (?, ?)''', (name, currency))
-        self.conn.commit()
-        portfolio_id = self.cursor.lastrowid
+        with transaction(self.conn) as cursor:
+            cursor.execute('''INSERT INTO portfolios (name, currency) VALUES (?, ?)''', (name, currency))
+            portfolio_id = cursor.lastrowid
         self.create_portfolio_object(portfolio_id, name, currency)
         print(f"Portfolio '{name}' created successfully.")
 
     def select_portfolio(self):
         print("\n===== Select Portfolio =====")
-        portfolios = list(self.portfolios.values())
+        portfolios = self.portfolios.names()
         if not portfolios:
             print("No portfolios available. Please create a portfolio first.")
             return None
 
-        for idx, portfolio in enumerate(portfolios, start=1):
-            print(f"{idx}. {portfolio.name}")
+        for idx, (portfolio_id, name) in enumerate(portfolios, start=1):
+            print(f"{idx}. {name}")
         choice = int(input("Enter portfolio number: "))
         if 1 <= choice <= len(portfolios):
-            return portfolios[choice - 1]
+            return self.portfolios[portfolios[choice - 1][0]]
         else:
             print("Invalid portfolio number. Please try again.")
             return None
 
-    def get_coin_suggestions(self, query, page=1, items_per_page=5):
+    def get_coin_suggestions(self, query, after=None, items_per_page=5):
         """
-        Get coin suggestions based on the user query and pagination parameters.
+        Get ranked coin suggestions for the user query.
+
+        Returns (suggestions, next_after): pass next_after back as `after` to get the following page.
         """
-        query = query.lower()
-        offset = (page - 1) * items_per_page
-        self.cursor.execute("SELECT coin_id, symbol, name FROM crypto_lookup WHERE coin_id LIKE ? OR symbol LIKE ? OR name LIKE ? OR name LIKE ? OR name LIKE ? LIMIT ? OFFSET ?",
-                            (f"%{query}%", f"%{query}%", f"%{query}%", f"%{query}%", f"%{query}%", items_per_page, offset))
-        return self.cursor.fetchall()
+        query = query.strip().lower()
+        if not query:
+            return [], None
+        after_rank, after_length, after_coin_id = after or (-1, 0, '')
+        params = {
+            'query': query,
+            'after_rank': after_rank,
+            'after_length': after_length,
+            'after_coin_id': after_coin_id,
+            'limit': items_per_page,
+        }
+        if len(query) < 3:
+            params['query_end'] = query + '\uffff'
+            self.cursor.execute(SEARCH_COINS_SHORT, params)
+        else:
+            escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params['prefix'] = escaped + '%'
+            params['match'] = '"' + query.replace('"', '""') + '"'
+            self.cursor.execute(SEARCH_COINS, params)
+        rows = self.cursor.fetchall()
+        suggestions = [(coin_id, symbol, name) for coin_id, symbol, name, rank in rows]
+        next_after = None
+        if rows:
+            coin_id, symbol, name, rank = rows[-1]
+            next_after = (rank, len(coin_id), coin_id)
+        return suggestions, next_after
 
     def get_coin_url(self, coin_id):
         """
@@ -349,9 +491,10 @@ class CoinGeckoCLI:
     def add_transaction(self, portfolio):
         coin_input = input("Enter coin ID, symbol, or name: ")
         coin_id = None  # Initialize coin_id variable
-        page = 1
+        # Keyset of the row before each visited page, so 'p' can step back
+        page_keys = [None]
         while True:
-            suggestions = self.get_coin_suggestions(coin_input, page=page)
+            suggestions, next_after = self.get_coin_suggestions(coin_input, after=page_keys[-1])
 
             if suggestions:
                 print("Suggestions:")
@@ -366,9 +509,9 @@ class CoinGeckoCLI:
                     print("Transaction canceled.")
                     return
                 elif choice == 'n':
-                    page += 1
-                elif choice == 'p' and page > 1:
-                    page -= 1
+                    page_keys.append(next_after)
+                elif choice == 'p' and len(page_keys) > 1:
+                    page_keys.pop()
                 elif choice.isdigit() and 1 <= int(choice) <= len(suggestions):
                     coin_id = suggestions[int(choice) - 1][0]
                     break  # Break out of the loop if a valid choice is made
@@ -404,25 +547,134 @@ class CoinGeckoCLI:
         portfolio.update_prices()
         print("Prices updated successfully.")
 
-    def view_portfolio(self, portfolio, display_mode='cli'):
-        portfolio_value = portfolio.get_portfolio_value()
-        portfolio_history = portfolio.get_portfolio_history()
-        if display_mode == 'cli':
-            print("Portfolio Value:")
-            print(json.dumps(portfolio_value, indent=4))
-        elif display_mode == 'web':
-            with open("portfolio_template.html", "r") as template_file:
-                template_content = template_file.read()
-            template_content = template_content.replace("{{portfolio_value}}", json.dumps(portfolio_value))
-            template_content = template_content.replace("{{portfolio_history}}", json.dumps(portfolio_history))
-            with open("portfolio_value.html", "w") as output_file:
-                output_file.write(template_content)
-            webbrowser.open_new_tab("portfolio_value.html")
-            print("Portfolio value saved to portfolio_value.html and opened automatically.")
-        else:
+    def refresh_all_prices(self):
+        print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] Updating prices for all portfolios...")
+        # The shared chain keeps provider health between scheduled refreshes
+        from providers import get_default_providers
+        report = refresh_all_prices(self.conn, self.fetcher, providers=get_default_providers())
+        print(f"{report['fetched']} prices fetched, {report['fresh']} still fresh, "
+              f"{report['converted']} prices in other currencies, {report['snapshots']} history snapshots stored.")
+        for provider, count in sorted(report['fallback'].items()):
+            print(f"{count} prices filled in from {provider}.")
+        if report['failed']:
+            print(f"Failed to update data for {', '.join(report['failed'])}. Please try again later.")
+        if report['skipped_portfolios']:
+            names = [self.portfolios.names_by_id().get(portfolio_id, str(portfolio_id))
+                     for portfolio_id in report['skipped_portfolios']]
+            print(f"Not storing history for {', '.join(names)} because some prices were not fetched.")
+        return report
+
+    @timed('view_portfolio')
+    def view_portfolio(self, portfolio, display_mode='cli', currency=None):
+        if display_mode == 'web':
+            url = self.start_web_server().portfolio_url(portfolio.portfolio_id)
+            if portfolio.portfolio_id in self._opened_pages:
+                print(f"Portfolio page is already open at {url} and updates automatically.")
+                return
+            import webbrowser
+            webbrowser.open_new_tab(url)
+            self._opened_pages.add(portfolio.portfolio_id)
+            print(f"Portfolio page opened at {url}. It updates automatically while the CLI is running.")
+            return
+        if display_mode != 'cli':
             print("Invalid display mode. Defaulting to CLI.")
-            print("Portfolio Value:")
-            print(json.dumps(portfolio_value, indent=4))
+        self.print_value(portfolio.get_portfolio_value(currency))
+
+    def view_all_portfolios(self):
+        currency = input("Enter currency (default: usd): ").lower() or 'usd'
+        self.print_value(portfolio_value(self.cursor, currency))
+
+    @staticmethod
+    def print_value(value):
+        print("Portfolio Value:")
+        print(json.dumps(value, indent=4))
+        total = sum(details['amount'] * details['price'] for details in value['coins'].values())
+        print(f"Total: {total:.2f} {value['currency']}")
+        if value['missing']:
+            print(f"No stored {value['currency']} price for {', '.join(value['missing'])}; "
+                  f"update prices or add the currency to PRICE_VS_CURRENCIES.")
+
+    def start_web_server(self):
+        """
+        Start the local web server in the background the first time it is needed.
+        """
+        if self._web_server is None:
+            from webserver import PortfolioServer
+            try:
+                self._web_server = PortfolioServer()
+            except OSError:
+                # The configured port is taken (e.g. by a `serve` process); let the OS pick one
+                self._web_server = PortfolioServer(port=0)
+            self._web_server.start()
+        return self._web_server
+
+    def serve(self, host=None, port=None, portfolio=None, open_browser=False):
+        """
+        Run the local web server in the foreground until interrupted.
+        """
+        from webserver import PortfolioServer
+        server = PortfolioServer(host, port, verbose=True)
+        url = server.portfolio_url(portfolio.portfolio_id) if portfolio else server.url
+        print(f"Serving portfolios at {url} (Ctrl+C to stop)")
+        if open_browser:
+            import webbrowser
+            webbrowser.open_new_tab(url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def import_portfolio(self, portfolio):
+        import_path = input("Enter the path to the portfolio file (.json, .jsonl or .csv): ")
+        import_path = os.path.abspath(os.path.expanduser(import_path))
+        try:
+            report = portfolio.import_transactions(import_path)
+        except FileNotFoundError:
+            print("File not found. Please check the file path and try again.")
+            return
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print("Invalid format in the portfolio file.")
+            return
+        print(f"Imported {report['imported']} transactions, {report['failed']} rows rejected.")
+        for row_number, message in report['errors']:
+            print(f"  row {row_number}: {message}")
+        if report['failed'] > len(report['errors']):
+            print(f"  ... and {report['failed'] - len(report['errors'])} more")
+        for row_number, message in report['warnings']:
+            print(f"  row {row_number}: warning: {message}")
+        print("Portfolio imported successfully.")
+
+    def view_profit_and_loss(self, portfolio):
+        method = input("Cost basis method (fifo, lifo, average; default: fifo): ").lower() or None
+        try:
+            pnl = portfolio.get_profit_and_loss(method)
+        except ValueError as error:
+            print(error)
+            return
+        print(f"\n{'Coin':<24}{'Amount':>16}{'Cost basis':>16}{'Value':>16}{'Unrealized':>16}{'Realized':>16}")
+        for coin_id, summary in sorted(pnl['coins'].items()):
+            value = f"{summary['value']:.2f}" if summary['value'] is not None else '-'
+            unrealized = f"{summary['unrealized_pnl']:.2f}" if summary['unrealized_pnl'] is not None else '-'
+            print(f"{coin_id:<24}{summary['amount']:>16.8g}{summary['cost_basis']:>16.2f}{value:>16}"
+                  f"{unrealized:>16}{summary['realized_pnl']:>16.2f}")
+        totals = pnl['totals']
+        print(f"{'Total (' + pnl['method'] + ')':<40}{totals['cost_basis']:>16.2f}{totals['value']:>16.2f}"
+              f"{totals['unrealized_pnl']:>16.2f}{totals['realized_pnl']:>16.2f} {portfolio.currency}")
+
+    def reconstruct_value_history(self, portfolio):
+        start = input("Enter start date (YYYY-MM-DD, default: first transaction): ") or None
+        end = input("Enter end date (YYYY-MM-DD, default: now): ") or None
+        try:
+            curve = portfolio.get_value_curve(start, end)
+        except ValueError:
+            print("Invalid date. Please use the YYYY-MM-DD format.")
+            return
+        if curve['missing']:
+            print(f"No price history for: {', '.join(curve['missing'])}")
+        for timestamp, value in zip(curve['timestamps'], curve['values']):
+            print(f"{datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')}  {value:.2f} {portfolio.currency}")
 
     def delete_portfolio(self, portfolio):
         portfolio.delete_portfolio()
@@ -449,25 +701,12 @@ class CoinGeckoCLI:
                             self.update_prices(portfolio)
                         elif choice == '3':
                             display_mode = input("Choose display mode (cli/web): ")
-                            self.view_portfolio(portfolio, display_mode)
+                            currency = None
+                            if display_mode != 'web':
+                                currency = input(f"Enter currency (default: {portfolio.currency}): ").lower() or None
+                            self.view_portfolio(portfolio, display_mode, currency)
                         elif choice == '4':
-                            portfolio_json_path = input("Enter the path to the portfolio.json file: ")
-                            portfolio_json_path = os.path.abspath(os.path.expanduser(portfolio_json_path))
-                            try:
-                                with open(portfolio_json_path, 'r') as f:
-                                    portfolio_data = json.load(f)
-                                    for coin_id, details in portfolio_data.items():
-                                        amount = details['amount']
-                                        price_per_coin = details['price_per_coin']
-                                        date = details['date']
-                                        transaction_type = details['transaction_type']
-                                        portfolio.add_transaction(coin_id, amount, price_per_coin, date,
-                                                                  transaction_type)
-                                print("Portfolio imported successfully.")
-                            except FileNotFoundError:
-                                print("File not found. Please check the file path and try again.")
-                            except json.JSONDecodeError:
-                                print("Invalid JSON format in the portfolio file.")
+                            self.import_portfolio(portfolio)
                         elif choice == '5':
                             self.modify_transactions(portfolio)
                         elif choice == '6':
@@ -475,18 +714,217 @@ class CoinGeckoCLI:
                             if confirm.lower() == 'yes':
                                 self.delete_portfolio(portfolio)
                                 break
+                        elif choice == '7':
+                            self.reconstruct_value_history(portfolio)
+                        elif choice == '8':
+                            self.view_profit_and_loss(portfolio)
                         elif choice == '0':
                             break
                         else:
                             print("Invalid choice. Please try again.")
             elif choice == '3':
                 self.refresh_coingecko_list()
+            elif choice == '4':
+                self.rebuild_positions()
+            elif choice == '5':
+                self.compact_database()
+            elif choice == '6':
+                self.refresh_all_prices()
+            elif choice == '7':
+                self.view_all_portfolios()
             elif choice == '0':
                 print("Exiting...")
                 break
             else:
                 print("Invalid choice. Please try again.")
 
-if __name__ == "__main__":
+    def find_portfolio(self, key):
+        """
+        Return the manager for a portfolio id or name, or None.
+        """
+        for portfolio_id, name in self.portfolios.names():
+            if str(portfolio_id) == str(key) or name == key:
+                return self.portfolios[portfolio_id]
+        print(f"Portfolio '{key}' not found.")
+        return None
+
+    def run_command(self, args):
+        """
+        Run one non-interactive command parsed by build_parser; returns the process exit code.
+        """
+        if args.command == 'list':
+            for portfolio_id, name in self.portfolios.names():
+                print(f"{portfolio_id}\t{name}\t{self.portfolios[portfolio_id].currency}")
+            return 0
+
+        if args.command == 'refresh':
+            if not args.portfolio:
+                report = self.refresh_all_prices()
+                return 1 if report['failed'] else 0
+            exit_code = 0
+            for key in args.portfolio:
+                portfolio = self.find_portfolio(key)
+                if portfolio is None or not portfolio.update_prices(batched=not args.per_coin):
+                    exit_code = 1
+            return exit_code
+
+        if args.command == 'sync-coins':
+            return 0 if self.refresh_coingecko_list(args.force) else 1
+
+        if args.command == 'total':
+            print(json.dumps(portfolio_value(self.cursor, args.currency.lower()), indent=4))
+            return 0
+
+        if args.command == 'serve':
+            self.serve(args.host, args.port, open_browser=args.open)
+            return 0
+
+        if args.command == 'schedule':
+            from scheduler import RefreshScheduler
+            print(f"Refreshing all portfolios every {args.interval}s (jitter {args.jitter}s). Stop with SIGTERM or Ctrl+C.")
+            RefreshScheduler(self.refresh_all_prices, args.interval, args.jitter, args.max_backoff,
+                             args.metrics_file).run()
+            return 0
+
+        portfolio = self.find_portfolio(args.portfolio)
+        if portfolio is None:
+            return 1
+
+        if args.command == 'view':
+            if args.web:
+                self.serve(portfolio=portfolio, open_browser=True)
+                return 0
+            # Keep stdout parseable: route progress messages to stderr
+            with redirect_stdout(sys.stderr), phase('view_portfolio'):
+                output = {'portfolio': portfolio.name, 'currency': args.currency or portfolio.currency,
+                          'value': portfolio.get_portfolio_value(args.currency)}
+                if args.history:
+                    try:
+                        output['history'] = portfolio.get_portfolio_history(args.start, args.end, args.resolution)
+                    except ValueError:
+                        print("Invalid date. Please use the YYYY-MM-DD or YYYY-MM-DD HH:MM:SS format.")
+                        return 1
+            print(json.dumps(output, indent=4))
+            return 0
+
+        if args.command == 'pnl':
+            try:
+                print(json.dumps(portfolio.get_profit_and_loss(args.method), indent=4))
+            except ValueError as error:
+                print(error)
+                return 1
+            return 0
+
+        if args.command == 'import':
+            try:
+                report = portfolio.import_transactions(os.path.abspath(os.path.expanduser(args.path)), args.format)
+            except FileNotFoundError:
+                print("File not found. Please check the file path and try again.")
+                return 1
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                print("Invalid format in the portfolio file.")
+                return 1
+            print(f"Imported {report['imported']} transactions, {report['failed']} rows rejected.")
+            for row_number, message in report['errors']:
+                print(f"  row {row_number}: {message}")
+            for row_number, message in report['warnings']:
+                print(f"  row {row_number}: warning: {message}")
+            return 1 if report['failed'] else 0
+
+        if args.command == 'export':
+            from importer import export_transactions
+            file_format = args.format or ('csv' if args.output.endswith('.csv') else
+                                          'jsonl' if args.output.endswith('.jsonl') else 'json')
+            if args.output == '-':
+                export_transactions(self.conn, portfolio.portfolio_id, sys.stdout, file_format)
+            else:
+                with open(args.output, 'w', newline='') as output_file:
+                    count = export_transactions(self.conn, portfolio.portfolio_id, output_file, file_format)
+                print(f"Exported {count} transactions to {args.output}.")
+            return 0
+
+        return 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="CoinGecko portfolio manager. Run without a command for the interactive menu.")
+    parser.add_argument('--profile', action='store_true',
+                        help="print time spent per operation, HTTP endpoint and SQL statement kind to stderr")
+    parser.add_argument('--metrics-file',
+                        help="write metrics here on exit, and after every scheduled refresh: JSON if the name "
+                             "ends in .json, else Prometheus text (default: PORTFOLIO_METRICS_FILE)")
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('list', help="list portfolios")
+
+    sync_coins = commands.add_parser('sync-coins', help="refresh the CoinGecko coin list used for suggestions")
+    sync_coins.add_argument('--force', action='store_true',
+                            help="download even if unchanged and apply large delistings")
+
+    refresh = commands.add_parser('refresh', help="update prices and store a history snapshot")
+    refresh.add_argument('--portfolio', action='append',
+                         help="portfolio id or name, may be repeated (default: all portfolios, each coin fetched once)")
+    refresh.add_argument('--per-coin', action='store_true', help="use one /coins/{id} request per coin")
+
+    view = commands.add_parser('view', help="print a portfolio's value as JSON")
+    view.add_argument('portfolio', help="portfolio id or name")
+    view.add_argument('--history', action='store_true', help="include value history")
+    view.add_argument('--start', help="history start (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)")
+    view.add_argument('--end', help="history end (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)")
+    view.add_argument('--resolution', choices=('raw', 'hour', 'day', 'week'), help="history resolution")
+    view.add_argument('--currency', help="quote currency (default: the portfolio's), from stored prices")
+    view.add_argument('--web', action='store_true', help="serve and open the web view instead")
+
+    total = commands.add_parser('total', help="print all portfolios combined as JSON")
+    total.add_argument('--currency', default='usd', help="quote currency (default: usd), from stored prices")
+
+    pnl = commands.add_parser('pnl', help="print cost basis and profit and loss as JSON")
+    pnl.add_argument('portfolio', help="portfolio id or name")
+    pnl.add_argument('--method', choices=('fifo', 'lifo', 'average'), help="cost basis method (default: fifo)")
+
+    import_parser = commands.add_parser('import', help="bulk import transactions from a file")
+    import_parser.add_argument('portfolio', help="portfolio id or name")
+    import_parser.add_argument('path', help="JSON, JSONL or CSV file")
+    import_parser.add_argument('--format', choices=('json', 'jsonl', 'csv'), help="file format (default: from extension)")
+
+    export = commands.add_parser('export', help="export transactions")
+    export.add_argument('portfolio', help="portfolio id or name")
+    export.add_argument('-o', '--output', default='-', help="output file (default: stdout)")
+    export.add_argument('--format', choices=('json', 'jsonl', 'csv'), help="file format (default: from extension)")
+
+    serve = commands.add_parser('serve', help="run the local web server for the portfolio pages")
+    serve.add_argument('--host', help="interface to listen on (default: PORTFOLIO_WEB_HOST or 127.0.0.1)")
+    serve.add_argument('--port', type=int, help="port to listen on (default: PORTFOLIO_WEB_PORT or 8765)")
+    serve.add_argument('--open', action='store_true', help="open the page in a browser")
+
+    schedule = commands.add_parser('schedule', help="refresh all portfolios periodically until stopped")
+    schedule.add_argument('--interval', type=float, default=300, help="seconds between refreshes (default: 300)")
+    schedule.add_argument('--jitter', type=float, default=30, help="random offset in seconds (default: 30)")
+    schedule.add_argument('--max-backoff', type=float, default=3600,
+                          help="longest wait after repeated failures in seconds (default: 3600)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
     cli = CoinGeckoCLI()
-    cli.run()
+    # Read after CoinGeckoCLI has loaded .env
+    args.metrics_file = args.metrics_file or os.getenv("PORTFOLIO_METRICS_FILE")
+    try:
+        if args.command is None:
+            cli.run()
+            return 0
+        return cli.run_command(args)
+    finally:
+        if args.profile:
+            print(format_profile(), file=sys.stderr)
+        if args.metrics_file:
+            try:
+                metrics.write(args.metrics_file)
+            except OSError as error:
+                print(f"Failed to write metrics to {args.metrics_file}: {error}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+import json
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+from database import PRICE_CHANGE_PERIODS, store_price_snapshots, transaction
+from history import record_snapshot
+from instrumentation import phase, timed
+from sql_queries import (
+    SELECT_ACTIVE_POSITION_PRICES,
+    SELECT_AGGREGATE_VALUE,
+    SELECT_PORTFOLIO_VALUE,
+    SELECT_PRICE_TIMES,
+    SELECT_UNPRICED_POSITIONS,
+    UPSERT_PRICE_MATRIX,
+)
+
+# /coins/markets accepts up to 250 ids per page
+MARKETS_CHUNK_SIZE = 250
+PRICE_CHANGE_WINDOWS = ('1h', '24h', '7d', '14d', '30d', '200d', '1y')
+# Prices newer than this are not fetched again by refresh_all_prices
+DEFAULT_FRESHNESS_SECONDS = 60
+# Quote currencies kept for every held coin besides each portfolio's own (PRICE_VS_CURRENCIES)
+DEFAULT_VS_CURRENCIES = 'usd,eur,btc'
+
+
+def price_vs_currencies():
+    return [currency.strip().lower()
+            for currency in os.getenv("PRICE_VS_CURRENCIES", DEFAULT_VS_CURRENCIES).split(',') if currency.strip()]
+
+
+def market_to_coin_data(market, vs_currency):
+    """
+    Reshape a /coins/markets row into the /coins/{id} layout used for price snapshots.
+    """
+    market_data = {'current_price': {vs_currency: market['current_price']}}
+    for window in PRICE_CHANGE_WINDOWS:
+        change = market.get(f'price_change_percentage_{window}_in_currency')
+        market_data[f'price_change_percentage_{window}_in_currency'] = \
+            {vs_currency: change} if change is not None else {}
+    # markets has no 60d window; keep the key so lookups fall back to 0
+    market_data['price_change_percentage_60d_in_currency'] = {}
+    return {'id': market['id'], 'symbol': market.get('symbol'), 'name': market.get('name'),
+            'market_data': market_data}
+
+
+def store_coin_data(cursor, coin_id, coin_data, last_updated, raw_payload=None, store_raw=False):
+    """
+    Write the typed price snapshot for a /coins/{id} style payload, plus the raw payload if enabled.
+    """
+    store_price_snapshots(cursor, coin_id, coin_data, last_updated)
+    raw_json = json.dumps(raw_payload if raw_payload is not None else coin_data) if store_raw else None
+    cursor.execute(
+        '''INSERT OR REPLACE INTO coins (coin_id, coin_data, last_updated) VALUES (?, ?, ?)''',
+        (coin_id, raw_json, last_updated))
+
+
+def fetch_market_prices(fetcher, coins_by_currency):
+    """
+    Fetch /coins/markets for {vs_currency: coin_ids} in chunks, all chunks running concurrently.
+
+    Returns {vs_currency: {coin_id: market_row}}; coins that could not be fetched are left out.
+    """
+    tasks = []
+    for vs_currency, coin_ids in coins_by_currency.items():
+        coin_ids = list(coin_ids)
+        for start in range(0, len(coin_ids), MARKETS_CHUNK_SIZE):
+            tasks.append((vs_currency, coin_ids[start:start + MARKETS_CHUNK_SIZE]))
+
+    def fetch_chunk(task):
+        vs_currency, chunk = task
+        params = {
+            'vs_currency': vs_currency,
+            'ids': ','.join(chunk),
+            'price_change_percentage': ','.join(PRICE_CHANGE_WINDOWS),
+            'per_page': len(chunk),
+            'page': 1,
+        }
+        return fetcher.get_json("coins/markets", params)
+
+    markets_by_currency = {vs_currency: {} for vs_currency in coins_by_currency}
+    for (vs_currency, chunk), markets in zip(tasks, fetcher.map(fetch_chunk, tasks)):
+        for market in markets or []:
+            if market.get('current_price') is not None:
+                markets_by_currency[vs_currency][market['id']] = market
+    return markets_by_currency
+
+
+def fetch_price_matrix(fetcher, coin_ids, vs_currencies):
+    """
+    Fetch /simple/price for every coin in every quote currency, one request per chunk of coins.
+
+    Returns {coin_id: {vs_currency: (price, change_24h)}}; missing pairs are left out.
+    """
+    coin_ids = list(coin_ids)
+    chunks = [coin_ids[start:start + MARKETS_CHUNK_SIZE] for start in range(0, len(coin_ids), MARKETS_CHUNK_SIZE)]
+
+    def fetch_chunk(chunk):
+        params = {'ids': ','.join(chunk), 'vs_currencies': ','.join(vs_currencies), 'include_24hr_change': 'true'}
+        return fetcher.get_json("simple/price", params)
+
+    matrix = {}
+    for prices in fetcher.map(fetch_chunk, chunks):
+        for coin_id, quotes in (prices or {}).items():
+            for vs_currency in vs_currencies:
+                if quotes.get(vs_currency) is not None:
+                    matrix.setdefault(coin_id, {})[vs_currency] = (quotes[vs_currency],
+                                                                  quotes.get(f'{vs_currency}_24h_change'))
+    return matrix
+
+
+def store_price_matrix(cursor, matrix, last_updated):
+    cursor.executemany(UPSERT_PRICE_MATRIX, [(coin_id, vs_currency, price, change, last_updated)
+                                             for coin_id, quotes in matrix.items()
+                                             for vs_currency, (price, change) in quotes.items()])
+
+
+def store_market_prices(cursor, markets, vs_currency, last_updated, store_raw=False):
+    for coin_id, market in markets.items():
+        store_coin_data(cursor, coin_id, market_to_coin_data(market, vs_currency), last_updated, market, store_raw)
+
+
+def portfolio_value(cursor, vs_currency, portfolio_id=None):
+    """
+    Value a portfolio, or every live portfolio combined, from stored prices only.
+
+    Returns {'currency', 'coins': {coin_id: {'amount', 'price', 'price_change_*'}}, 'missing': [coin_id]},
+    where `missing` lists held coins with no stored price in `vs_currency`.
+    """
+    params = {'portfolio_id': portfolio_id, 'vs_currency': vs_currency}
+    cursor.execute(SELECT_PORTFOLIO_VALUE if portfolio_id is not None else SELECT_AGGREGATE_VALUE, params)
+    coins = {}
+    for coin_id, amount, price, *changes in cursor.fetchall():
+        coin_entry = {'amount': amount, 'price': price}
+        for period, change in zip(PRICE_CHANGE_PERIODS, changes):
+            coin_entry[f'price_change_{period}'] = change if change is not None else 0
+        coins[coin_id] = coin_entry
+    cursor.execute(SELECT_UNPRICED_POSITIONS, params)
+    return {'currency': vs_currency, 'coins': coins, 'missing': [coin_id for coin_id, in cursor.fetchall()]}
+
+
+def portfolio_snapshot_coins(cursor, portfolio_id, vs_currency):
+    """
+    Return {coin_id: (amount, price)} for a portfolio from positions and stored prices.
+    """
+    cursor.execute(SELECT_PORTFOLIO_VALUE, {'portfolio_id': portfolio_id, 'vs_currency': vs_currency})
+    return {coin_id: (amount, price) for coin_id, amount, price, *changes in cursor.fetchall()}
+
+
+@timed('refresh_all_prices')
+def refresh_all_prices(conn, fetcher, freshness_seconds=None, store_raw=False, providers=None):
+    """
+    Refresh prices for every live portfolio, fetching each stale (coin, currency) pair once.
+
+    Prices newer than `freshness_seconds` (PRICE_FRESHNESS_SECONDS, default 60) are reused.
+    Stale prices come from `providers` (default: the PRICE_PROVIDERS chain on `fetcher`), so coins CoinGecko
+    fails to price are filled in from the fallback provider.
+    Every held coin is also priced in every portfolio currency and PRICE_VS_CURRENCIES, with one
+    /simple/price request per chunk of coins, so other currencies can be shown without fetching.
+    All prices and one history snapshot per portfolio are written in a single transaction;
+    portfolios with a coin that failed to refresh get no snapshot.
+    """
+    if freshness_seconds is None:
+        freshness_seconds = int(os.getenv("PRICE_FRESHNESS_SECONDS", DEFAULT_FRESHNESS_SECONDS))
+    now = datetime.now()
+    last_updated = now.strftime("%Y-%m-%d %H:%M:%S")
+    cutoff = (now - timedelta(seconds=freshness_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+
+    cursor = conn.cursor()
+    cursor.execute(SELECT_ACTIVE_POSITION_PRICES)
+    portfolios = {}
+    coins_by_currency = {}
+    stale_by_currency = {}
+    for portfolio_id, vs_currency, coin_id, price_updated in cursor.fetchall():
+        portfolios.setdefault(portfolio_id, (vs_currency, set()))[1].add(coin_id)
+        coins_by_currency.setdefault(vs_currency, set()).add(coin_id)
+        if price_updated is None or price_updated < cutoff:
+            stale_by_currency.setdefault(vs_currency, set()).add(coin_id)
+
+    if providers is None:
+        from providers import build_providers
+        providers = build_providers(fetcher)
+    with phase('fetch_markets'):
+        markets_by_currency = providers.fetch_market_prices(cursor, {vs_currency: sorted(coin_ids) for vs_currency,
+                                                                     coin_ids in stale_by_currency.items()})
+    failed_by_currency = {vs_currency: coin_ids - set(markets_by_currency[vs_currency])
+                          for vs_currency, coin_ids in stale_by_currency.items()}
+
+    # Fill in every other (held coin, currency) pair, e.g. EUR prices for coins only held in USD portfolios
+    matrix_currencies = sorted(set(price_vs_currencies()) | set(coins_by_currency))
+    held_coins = set().union(*coins_by_currency.values())
+    matrix_coins = set()
+    for vs_currency in matrix_currencies:
+        cursor.execute(SELECT_PRICE_TIMES, (vs_currency,))
+        fresh = {coin_id for coin_id, _, price_updated in cursor.fetchall() if price_updated >= cutoff}
+        matrix_coins |= held_coins - fresh - set(markets_by_currency.get(vs_currency, ()))
+    with phase('fetch_matrix'):
+        matrix = fetch_price_matrix(fetcher, sorted(matrix_coins), matrix_currencies) if matrix_coins else {}
+    # /coins/markets rows carry more change windows; don't overwrite them with /simple/price
+    for vs_currency, markets in markets_by_currency.items():
+        for coin_id in markets:
+            matrix.get(coin_id, {}).pop(vs_currency, None)
+
+    report = {
+        'fetched': sum(len(markets) for markets in markets_by_currency.values()),
+        'fresh': sum(len(coin_ids) for coin_ids in coins_by_currency.values())
+        - sum(len(coin_ids) for coin_ids in stale_by_currency.values()),
+        'failed': sorted(f"{coin_id} ({vs_currency})" for vs_currency, coin_ids in failed_by_currency.items()
+                         for coin_id in coin_ids),
+        'converted': sum(len(quotes) for quotes in matrix.values()),
+        'fallback': Counter(market.get('provider') for markets in markets_by_currency.values()
+                            for market in markets.values() if market.get('provider') != providers.primary),
+        'snapshots': 0,
+        'skipped_portfolios': [],
+    }
+    with phase('write'), transaction(conn) as cursor:
+        providers.save(cursor)
+        for vs_currency, markets in markets_by_currency.items():
+            store_market_prices(cursor, markets, vs_currency, last_updated, store_raw)
+        store_price_matrix(cursor, matrix, last_updated)
+        for portfolio_id, (vs_currency, coin_ids) in portfolios.items():
+            if coin_ids & failed_by_currency.get(vs_currency, set()):
+                report['skipped_portfolios'].append(portfolio_id)
+                continue
+            record_snapshot(cursor, portfolio_id, last_updated, portfolio_snapshot_coins(cursor, portfolio_id, vs_currency))
+            report['snapshots'] += 1
+    return report
@@ -0,0 +1,358 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from fetcher import CoinGeckoFetcher, get_default_fetcher
+from prices import PRICE_CHANGE_WINDOWS, fetch_market_prices
+from sql_queries import SELECT_COIN_LISTING, SELECT_PROVIDER_COIN_IDS, UPSERT_PROVIDER_COIN_ID
+
+# Tried in this order (PRICE_PROVIDERS); later providers fill in what earlier ones could not price
+DEFAULT_PROVIDERS = 'coingecko,coinpaprika'
+# Seconds to wait for a provider before asking the next one for the same prices (PRICE_HEDGE_SECONDS)
+DEFAULT_HEDGE_SECONDS = 4.0
+# After this many failed requests in a row a provider is tried last for COOLDOWN_SECONDS
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 300
+# Weight of the latest request in a provider's moving average latency
+LATENCY_SMOOTHING = 0.3
+
+COINPAPRIKA_API_URL = "https://api.coinpaprika.com/v1"
+# The free plan allows bursts of 10 calls per second but only 20,000 calls per month
+COINPAPRIKA_RATE_LIMIT = 60
+# /tickers accepts at most this many quote currencies per request
+COINPAPRIKA_MAX_QUOTES = 3
+# Up to this many coins get one /tickers/{id} request each, within the fetcher's burst;
+# more are read from a single /tickers request
+COINPAPRIKA_PER_COIN_LIMIT = 4
+# Coins that could not be matched to a CoinPaprika id are looked up again after this many days
+ID_RECHECK_DAYS = 7
+
+
+class ProviderHealth:
+    """
+    Request outcomes and latency of one provider, kept for the life of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.unavailable_until = 0.0
+
+    def record(self, ok, elapsed):
+        with self.lock:
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+            if ok:
+                self.successes += 1
+                self.consecutive_failures = 0
+                self.unavailable_until = 0.0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= FAILURE_THRESHOLD:
+                    self.unavailable_until = time.monotonic() + COOLDOWN_SECONDS
+
+    def available(self):
+        return time.monotonic() >= self.unavailable_until
+
+    def summary(self):
+        with self.lock:
+            return {
+                'available': self.available(),
+                'successes': self.successes,
+                'failures': self.failures,
+                'consecutive_failures': self.consecutive_failures,
+                'latency': self.latency,
+            }
+
+
+class PriceProvider:
+    """
+    A source of /coins/markets style rows ({'id', 'symbol', 'name', 'current_price',
+    'price_change_percentage_<window>_in_currency', ...}) keyed by CoinGecko coin id.
+    """
+
+    name = None
+
+    def prepare(self, cursor, coin_ids):
+        """
+        Load what fetch_markets needs from the database; runs on the caller's thread.
+        """
+
+    def fetch_markets(self, coins_by_currency):
+        """
+        Return {vs_currency: {coin_id: market_row}}, leaving out coins that could not be priced.
+        Runs on a worker thread, so it must not touch the database.
+        """
+        raise NotImplementedError
+
+    def save(self, cursor):
+        """
+        Write back anything learned while fetching; the caller commits.
+        """
+
+
+class CoinGeckoProvider(PriceProvider):
+    name = 'coingecko'
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    def fetch_markets(self, coins_by_currency):
+        return fetch_market_prices(self.fetcher, coins_by_currency)
+
+
+class CoinPaprikaProvider(PriceProvider):
+    """
+    Prices from the CoinPaprika API, with CoinGecko ids mapped to CoinPaprika ids by symbol and name.
+    """
+
+    name = 'coinpaprika'
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.lock = threading.Lock()
+        # coin_id -> CoinPaprika id, or None if there is no match
+        self.ids = {}
+        # coin_id -> (symbol, name) for coins still to be matched
+        self.listings = {}
+        # coin_id -> (CoinPaprika id, checked_at) matched since the last save
+        self.matched = {}
+
+    def prepare(self, cursor, coin_ids):
+        recheck_before = (datetime.now() - timedelta(days=ID_RECHECK_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(SELECT_PROVIDER_COIN_IDS, (self.name,))
+        known = {coin_id: provider_coin_id for coin_id, provider_coin_id, checked_at in cursor.fetchall()
+                 if provider_coin_id or checked_at >= recheck_before}
+        with self.lock:
+            known.update((coin_id, provider_coin_id) for coin_id, (provider_coin_id, _) in self.matched.items())
+            self.ids = known
+            self.listings = {}
+            for coin_id in coin_ids:
+                if coin_id not in known:
+                    row = cursor.execute(SELECT_COIN_LISTING, (coin_id,)).fetchone()
+                    if row and row[0] and row[1]:
+                        self.listings[coin_id] = row
+
+    def fetch_markets(self, coins_by_currency):
+        coin_ids = set().union(*coins_by_currency.values())
+        self._match(coin_ids)
+        ids = {coin_id: self.ids[coin_id] for coin_id in coin_ids if self.ids.get(coin_id)}
+        markets = {vs_currency: {} for vs_currency in coins_by_currency}
+        if not ids:
+            return markets
+
+        currencies = sorted(coins_by_currency)
+        quote_groups = [','.join(currencies[start:start + COINPAPRIKA_MAX_QUOTES]).upper()
+                        for start in range(0, len(currencies), COINPAPRIKA_MAX_QUOTES)]
+        if len(ids) <= COINPAPRIKA_PER_COIN_LIMIT:
+            tasks = [(f"tickers/{provider_coin_id}", quotes) for provider_coin_id in sorted(set(ids.values()))
+                     for quotes in quote_groups]
+        else:
+            tasks = [("tickers", quotes) for quotes in quote_groups]
+        results = self.fetcher.map(lambda task: self.fetcher.get_json(task[0], {'quotes': task[1]}), tasks)
+
+        tickers = {}
+        for result in results:
+            if isinstance(result, dict):
+                result = [result]
+            for ticker in result or []:
+                entry = tickers.setdefault(ticker['id'], (ticker, {}))
+                entry[1].update(ticker.get('quotes') or {})
+
+        for coin_id, provider_coin_id in ids.items():
+            if provider_coin_id not in tickers:
+                continue
+            ticker, quotes = tickers[provider_coin_id]
+            for vs_currency, wanted in coins_by_currency.items():
+                quote = quotes.get(vs_currency.upper())
+                if coin_id in wanted and quote and quote.get('price') is not None:
+                    markets[vs_currency][coin_id] = self._market_row(coin_id, ticker, quote)
+        return markets
+
+    def save(self, cursor):
+        with self.lock:
+            matched, self.matched = self.matched, {}
+        cursor.executemany(UPSERT_PROVIDER_COIN_ID, [(self.name, coin_id, provider_coin_id, checked_at)
+                                                     for coin_id, (provider_coin_id, checked_at) in matched.items()])
+
+    def _match(self, coin_ids):
+        with self.lock:
+            listings = {coin_id: self.listings[coin_id] for coin_id in coin_ids if coin_id in self.listings}
+        if not listings:
+            return
+        coins = self.fetcher.get_json("coins")
+        if not coins:
+            return
+
+        # Prefer an exact symbol and name match, then the "<symbol>-<name>" id CoinPaprika usually assigns
+        by_listing = {}
+        active_ids = set()
+        for coin in coins:
+            if not coin.get('is_active', True):
+                continue
+            active_ids.add(coin['id'])
+            key = ((coin.get('symbol') or '').lower(), (coin.get('name') or '').lower())
+            best = by_listing.get(key)
+            # Rank 0 means unranked
+            if best is None or 0 < (coin.get('rank') or 0) < (best.get('rank') or float('inf')):
+                by_listing[key] = coin
+
+        checked_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            for coin_id, (symbol, name) in listings.items():
+                match = by_listing.get((symbol.lower(), name.lower()))
+                guess = f"{symbol.lower()}-{re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')}"
+                provider_coin_id = match['id'] if match else guess if guess in active_ids else None
+                self.ids[coin_id] = provider_coin_id
+                self.matched[coin_id] = (provider_coin_id, checked_at)
+                self.listings.pop(coin_id, None)
+
+    @staticmethod
+    def _market_row(coin_id, ticker, quote):
+        row = {
+            'id': coin_id,
+            'symbol': (ticker.get('symbol') or '').lower(),
+            'name': ticker.get('name'),
+            'current_price': quote['price'],
+            'market_cap': quote.get('market_cap'),
+            'total_volume': quote.get('volume_24h'),
+            'last_updated': ticker.get('last_updated'),
+        }
+        for window in PRICE_CHANGE_WINDOWS:
+            change = quote.get(f'percent_change_{window}')
+            if change is not None:
+                row[f'price_change_percentage_{window}_in_currency'] = change
+        return row
+
+
+class ProviderChain:
+    """
+    Price providers in order of preference, with hedged requests and fill-in from the others.
+
+    The first available provider is asked for every price. If it has not answered after
+    `hedge_after` seconds, the next one is asked as well and whichever answers first wins; coins a
+    provider could not price are asked of the next one. Providers that keep failing are tried
+    last until they recover.
+    """
+
+    def __init__(self, providers, hedge_after=None):
+        self.providers = list(providers)
+        if not self.providers:
+            raise ValueError("No price providers configured")
+        if hedge_after is None:
+            hedge_after = float(os.getenv("PRICE_HEDGE_SECONDS", DEFAULT_HEDGE_SECONDS))
+        self.hedge_after = hedge_after
+        self.health = {provider.name: ProviderHealth() for provider in self.providers}
+
+    @property
+    def primary(self):
+        return self.providers[0].name
+
+    def ranked(self):
+        return sorted(self.providers, key=lambda provider: not self.health[provider.name].available())
+
+    def fetch_market_prices(self, cursor, coins_by_currency):
+        """
+        Like prices.fetch_market_prices, but across providers; each row's 'provider' names its source.
+
+        Call save() inside the write transaction afterwards to keep what the providers learned.
+        """
+        markets = {vs_currency: {} for vs_currency in coins_by_currency}
+        wanted = {vs_currency: set(coin_ids) for vs_currency, coin_ids in coins_by_currency.items() if coin_ids}
+        if not wanted:
+            return markets
+        coin_ids = set().union(*wanted.values())
+        for provider in self.providers:
+            provider.prepare(cursor, coin_ids)
+
+        waiting = self.ranked()
+        executor = ThreadPoolExecutor(max_workers=len(waiting), thread_name_prefix='price-provider')
+        pending = set()
+        hedge = True
+        try:
+            while True:
+                remaining = {vs_currency: sorted(coin_ids.difference(markets[vs_currency]))
+                             for vs_currency, coin_ids in wanted.items()}
+                remaining = {vs_currency: coin_ids for vs_currency, coin_ids in remaining.items() if coin_ids}
+                if not remaining:
+                    break
+                if waiting and (hedge or not pending):
+                    pending.add(executor.submit(self._fetch, waiting.pop(0), remaining))
+                if not pending:
+                    break
+                done, pending = wait(pending, timeout=self.hedge_after if waiting else None,
+                                     return_when=FIRST_COMPLETED)
+                hedge = not done
+                for future in done:
+                    for vs_currency, rows in future.result().items():
+                        for coin_id, row in rows.items():
+                            markets[vs_currency].setdefault(coin_id, row)
+        finally:
+            # A provider that lost the race finishes in the background and its answer is dropped
+            executor.shutdown(wait=False)
+        return markets
+
+    def save(self, cursor):
+        for provider in self.providers:
+            provider.save(cursor)
+
+    def status(self):
+        return {name: health.summary() for name, health in self.health.items()}
+
+    def _fetch(self, provider, coins_by_currency):
+        started = time.monotonic()
+        try:
+            markets = provider.fetch_markets(coins_by_currency)
+        except Exception as error:
+            # An unexpected payload from one provider must not sink the whole refresh
+            print(f"Price provider {provider.name} failed: {error}")
+            markets = {}
+        self.health[provider.name].record(any(markets.values()), time.monotonic() - started)
+        for rows in markets.values():
+            for row in rows.values():
+                row['provider'] = provider.name
+        return markets
+
+
+def build_providers(fetcher=None, names=None, hedge_after=None):
+    """
+    Build a ProviderChain from comma separated provider names (default PRICE_PROVIDERS).
+    """
+    names = names or os.getenv("PRICE_PROVIDERS") or DEFAULT_PROVIDERS
+    providers = []
+    for name in names.split(','):
+        name = name.strip().lower()
+        if name == 'coingecko':
+            providers.append(CoinGeckoProvider(fetcher or get_default_fetcher()))
+        elif name == 'coinpaprika':
+            paprika_fetcher = CoinGeckoFetcher(
+                base_url=os.getenv("COINPAPRIKA_API_URL") or COINPAPRIKA_API_URL, api_key='',
+                rate_limit=float(os.getenv("COINPAPRIKA_RATE_LIMIT", COINPAPRIKA_RATE_LIMIT)))
+            providers.append(CoinPaprikaProvider(paprika_fetcher))
+        elif name:
+            raise ValueError(f"Unknown price provider '{name}'")
+    return ProviderChain(providers, hedge_after)
+
+
+_default_providers = None
+_default_providers_lock = threading.Lock()
+
+
+def get_default_providers():
+    """
+    Return the process-wide provider chain, so provider health carries over between refreshes.
+    """
+    global _default_providers
+    with _default_providers_lock:
+        if _default_providers is None:
+            _default_providers = build_providers()
+        return _default_providers
@@ -0,0 +1,109 @@
+import random
+import signal
+import threading
+import time
+from datetime import datetime
+
+from instrumentation import metrics
+
+
+class RefreshScheduler:
+    """
+    Runs a refresh callable every `interval` seconds until SIGTERM or SIGINT.
+
+    Each run is offset by up to `jitter` seconds so several schedulers (or a scheduler and
+    someone refreshing by hand) do not hit the API in the same rate-limit window. Failed runs
+    back off exponentially up to `max_backoff`. A stop signal lets the current run finish its
+    transaction before exiting; a second signal aborts immediately, which rolls the run back.
+    With `metrics_file`, the metrics are written there after every run for a scraper to pick up.
+    """
+
+    def __init__(self, refresh, interval=300, jitter=30, max_backoff=3600, metrics_file=None):
+        self.refresh = refresh
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.metrics_file = metrics_file
+        self.failures = 0
+        self._stop = threading.Event()
+        self._running = False
+
+    def stop(self, *args):
+        if self._stop.is_set() and self._running:
+            raise KeyboardInterrupt
+        self._stop.set()
+
+    def next_delay(self):
+        if self.failures:
+            delay = min(self.max_backoff, self.interval * (2 ** self.failures))
+        else:
+            delay = self.interval
+        return max(0.0, delay + random.uniform(-self.jitter, self.jitter))
+
+    def run_once(self):
+        """
+        Run one refresh and return True if it succeeded.
+
+        The refresh callable may return a report dict. The run only counts as failed if it raised or
+        nothing was fetched while some prices failed; a few unpriceable coins (e.g. delisted ones)
+        are logged but do not slow the schedule down.
+        """
+        self._running = True
+        succeeded = False
+        result = 'failure'
+        try:
+            with metrics.timer('scheduler_run_seconds'):
+                report = self.refresh()
+            failed = report.get('failed') if isinstance(report, dict) else None
+            if not failed:
+                succeeded, result = True, 'success'
+            elif report.get('fetched'):
+                succeeded, result = True, 'partial'
+                print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] Refresh completed with {len(failed)} "
+                      f"price(s) not updated.")
+        except KeyboardInterrupt:
+            raise
+        except Exception as error:
+            print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] Refresh failed: {error}")
+        finally:
+            self._running = False
+        metrics.count('scheduler_runs_total', result=result)
+        metrics.set('scheduler_last_run_timestamp_seconds', time.time())
+        if succeeded:
+            metrics.set('scheduler_last_success_timestamp_seconds', time.time())
+        return succeeded
+
+    def export_metrics(self):
+        metrics.set('scheduler_consecutive_failures', self.failures)
+        if not self.metrics_file:
+            return
+        try:
+            metrics.write(self.metrics_file)
+        except OSError as error:
+            print(f"Failed to write metrics to {self.metrics_file}: {error}")
+
+    def run(self):
+        previous_handlers = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            # Start at a random point of the first interval to spread load
+            if self._stop.wait(random.uniform(0, self.jitter)):
+                return
+            while not self._stop.is_set():
+                started = time.monotonic()
+                if self.run_once():
+                    self.failures = 0
+                else:
+                    self.failures += 1
+                self.export_metrics()
+                delay = self.next_delay()
+                if self.failures:
+                    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] Backing off for {delay:.0f}s "
+                          f"after {self.failures} failed refresh(es).")
+                else:
+                    # Keep a steady cadence: the interval counts from the start of the run
+                    delay -= time.monotonic() - started
+                self._stop.wait(max(0.0, delay))
+        finally:
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+        print("Scheduler stopped.")
@@ -46,4 +46,539 @@ CREATE TABLE IF NOT EXISTS history (
     portfolio_data TEXT,
     last_updated TEXT
 )
-'''
\ No newline at end of file
+'''
+
+CREATE_POSITIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS positions (
+    portfolio_id INTEGER,
+    coin_id TEXT,
+    amount REAL DEFAULT 0,
+    net_invested REAL DEFAULT 0,
+    transaction_count INTEGER DEFAULT 0,
+    PRIMARY KEY (portfolio_id, coin_id),
+    FOREIGN KEY (portfolio_id) REFERENCES portfolios(id)
+)
+'''
+
+# Adds a transaction (or the difference made by an edit) to the running position. net_invested is
+# the net cash flow, SUM(amount * price_per_coin); the cost basis of what is held comes from the ledger.
+APPLY_POSITION_DELTA = '''
+INSERT INTO positions (portfolio_id, coin_id, amount, net_invested, transaction_count)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (portfolio_id, coin_id) DO UPDATE SET
+    amount = amount + excluded.amount,
+    net_invested = net_invested + excluded.net_invested,
+    transaction_count = transaction_count + excluded.transaction_count
+'''
+
+# Recomputes positions from the transactions ledger. Pass portfolio_id = NULL for every portfolio.
+DELETE_POSITIONS = '''
+DELETE FROM positions WHERE :portfolio_id IS NULL OR portfolio_id = :portfolio_id
+'''
+
+REBUILD_POSITIONS = '''
+INSERT INTO positions (portfolio_id, coin_id, amount, net_invested, transaction_count)
+SELECT portfolio_id, coin_id, SUM(amount), SUM(amount * price_per_coin), COUNT(*)
+FROM transactions
+WHERE :portfolio_id IS NULL OR portfolio_id = :portfolio_id
+GROUP BY portfolio_id, coin_id
+'''
+
+# Current amount per coin for a portfolio. Pass coin_id = NULL to get every coin.
+SELECT_POSITIONS = '''
+SELECT coin_id, amount
+FROM positions
+WHERE portfolio_id = :portfolio_id AND (:coin_id IS NULL OR coin_id = :coin_id)
+'''
+
+# Keeps one row per coin_id, preferring rows with data and then the most recent one.
+DEDUPLICATE_COINS = '''
+DELETE FROM coins WHERE id NOT IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY coin_id ORDER BY coin_data IS NULL, last_updated DESC, id DESC
+        ) AS row_number
+        FROM coins
+    )
+    WHERE row_number = 1
+)
+'''
+
+CREATE_COINS_COIN_ID_INDEX = '''
+CREATE UNIQUE INDEX IF NOT EXISTS idx_coins_coin_id ON coins (coin_id)
+'''
+
+CREATE_TRANSACTIONS_PORTFOLIO_COIN_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_transactions_portfolio_coin ON transactions (portfolio_id, coin_id)
+'''
+
+CREATE_HISTORY_PORTFOLIO_DATE_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_history_portfolio_last_updated ON history (portfolio_id, last_updated)
+'''
+
+# Latest market data per coin and quote currency, replacing the raw /coins/{id} blobs in coins.coin_data.
+CREATE_PRICE_SNAPSHOTS_TABLE = '''
+CREATE TABLE IF NOT EXISTS price_snapshots (
+    coin_id TEXT,
+    vs_currency TEXT,
+    price REAL,
+    price_change_1h REAL,
+    price_change_24h REAL,
+    price_change_7d REAL,
+    price_change_14d REAL,
+    price_change_30d REAL,
+    price_change_60d REAL,
+    price_change_200d REAL,
+    price_change_1y REAL,
+    last_updated TEXT,
+    -- When the change windows were last written; /simple/price only refreshes the price and 24h change
+    changes_updated TEXT,
+    PRIMARY KEY (coin_id, vs_currency)
+) WITHOUT ROWID
+'''
+
+ADD_PRICE_SNAPSHOTS_CHANGES_UPDATED = '''
+ALTER TABLE price_snapshots ADD COLUMN changes_updated TEXT
+'''
+
+UPSERT_PRICE_SNAPSHOT = '''
+INSERT INTO price_snapshots (coin_id, vs_currency, price, price_change_1h, price_change_24h, price_change_7d,
+                             price_change_14d, price_change_30d, price_change_60d, price_change_200d,
+                             price_change_1y, last_updated, changes_updated)
+VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11, ?12, ?12)
+ON CONFLICT (coin_id, vs_currency) DO UPDATE SET
+    price = excluded.price,
+    price_change_1h = excluded.price_change_1h,
+    price_change_24h = excluded.price_change_24h,
+    price_change_7d = excluded.price_change_7d,
+    price_change_14d = excluded.price_change_14d,
+    price_change_30d = excluded.price_change_30d,
+    price_change_60d = excluded.price_change_60d,
+    price_change_200d = excluded.price_change_200d,
+    price_change_1y = excluded.price_change_1y,
+    last_updated = excluded.last_updated,
+    changes_updated = excluded.changes_updated
+'''
+
+# Current position and latest price per coin for a portfolio in one quote currency.
+SELECT_PORTFOLIO_VALUE = '''
+SELECT p.coin_id, p.amount, s.price, s.price_change_1h, s.price_change_24h, s.price_change_7d,
+       s.price_change_14d, s.price_change_30d, s.price_change_60d, s.price_change_200d, s.price_change_1y
+FROM positions AS p
+JOIN price_snapshots AS s ON s.coin_id = p.coin_id AND s.vs_currency = :vs_currency
+WHERE p.portfolio_id = :portfolio_id
+'''
+
+# Same as SELECT_PORTFOLIO_VALUE, summed over every live portfolio.
+SELECT_AGGREGATE_VALUE = '''
+SELECT p.coin_id, SUM(p.amount), s.price, s.price_change_1h, s.price_change_24h, s.price_change_7d,
+       s.price_change_14d, s.price_change_30d, s.price_change_60d, s.price_change_200d, s.price_change_1y
+FROM positions AS p
+JOIN portfolios AS pf ON pf.id = p.portfolio_id AND pf.deleted = 0
+JOIN price_snapshots AS s ON s.coin_id = p.coin_id AND s.vs_currency = :vs_currency
+GROUP BY p.coin_id
+'''
+
+# Held coins with no stored price in a quote currency. Pass portfolio_id = NULL for every live portfolio.
+SELECT_UNPRICED_POSITIONS = '''
+SELECT DISTINCT p.coin_id
+FROM positions AS p
+JOIN portfolios AS pf ON pf.id = p.portfolio_id AND pf.deleted = 0
+WHERE (:portfolio_id IS NULL OR p.portfolio_id = :portfolio_id) AND p.amount != 0
+  AND NOT EXISTS (SELECT 1 FROM price_snapshots AS s WHERE s.coin_id = p.coin_id AND s.vs_currency = :vs_currency)
+'''
+
+# Prices from /simple/price only carry the 24h change, so keep the other windows a /coins/markets
+# refresh may have stored for the same pair, and leave changes_updated so they still count as stale.
+UPSERT_PRICE_MATRIX = '''
+INSERT INTO price_snapshots (coin_id, vs_currency, price, price_change_24h, last_updated)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (coin_id, vs_currency) DO UPDATE SET
+    price = excluded.price,
+    price_change_24h = excluded.price_change_24h,
+    last_updated = excluded.last_updated
+'''
+
+SELECT_PRICE_TIMES = '''
+SELECT coin_id, vs_currency, last_updated FROM price_snapshots WHERE vs_currency = ?
+'''
+
+# Trigram index over the coin list for substring search. It keeps its own copy of the rows
+# (rather than using external content) because VACUUM may renumber crypto_lookup rowids.
+CREATE_CRYPTOLOOKUP_FTS_TABLE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS crypto_lookup_fts USING fts5(
+    coin_id,
+    symbol,
+    name,
+    tokenize = 'trigram'
+)
+'''
+
+CREATE_CRYPTOLOOKUP_FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS crypto_lookup_fts_insert AFTER INSERT ON crypto_lookup BEGIN
+        INSERT INTO crypto_lookup_fts (coin_id, symbol, name) VALUES (new.coin_id, new.symbol, new.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crypto_lookup_fts_delete AFTER DELETE ON crypto_lookup BEGIN
+        DELETE FROM crypto_lookup_fts WHERE coin_id = old.coin_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crypto_lookup_fts_update AFTER UPDATE OF coin_id, symbol, name ON crypto_lookup BEGIN
+        UPDATE crypto_lookup_fts SET coin_id = new.coin_id, symbol = new.symbol, name = new.name
+        WHERE coin_id = old.coin_id;
+    END
+    ''',
+]
+
+POPULATE_CRYPTOLOOKUP_FTS = '''
+INSERT INTO crypto_lookup_fts (coin_id, symbol, name) SELECT coin_id, symbol, name FROM crypto_lookup
+'''
+
+CREATE_CRYPTOLOOKUP_SYMBOL_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_crypto_lookup_symbol ON crypto_lookup (symbol)
+'''
+
+# Ranked coin search: exact symbol matches, then prefix matches, then substring matches.
+# Pages are fetched with keyset pagination on (rank, length(coin_id), coin_id).
+SEARCH_COINS = '''
+SELECT coin_id, symbol, name, rank FROM (
+    SELECT coin_id, symbol, name,
+        CASE
+            WHEN lower(symbol) = :query THEN 0
+            WHEN symbol LIKE :prefix ESCAPE '\\' OR coin_id LIKE :prefix ESCAPE '\\'
+                OR name LIKE :prefix ESCAPE '\\' THEN 1
+            ELSE 2
+        END AS rank
+    FROM crypto_lookup_fts
+    WHERE crypto_lookup_fts MATCH :match
+)
+WHERE (rank, length(coin_id), coin_id) > (:after_rank, :after_length, :after_coin_id)
+ORDER BY rank, length(coin_id), coin_id
+LIMIT :limit
+'''
+
+# Trigrams need at least three characters, so shorter queries use prefix range scans on the indexes.
+SEARCH_COINS_SHORT = '''
+SELECT coin_id, symbol, name, rank FROM (
+    SELECT coin_id, symbol, name, CASE WHEN symbol = :query THEN 0 ELSE 1 END AS rank
+    FROM crypto_lookup
+    WHERE ((symbol >= :query AND symbol < :query_end) OR (coin_id >= :query AND coin_id < :query_end))
+      AND delisted_at IS NULL
+)
+WHERE (rank, length(coin_id), coin_id) > (:after_rank, :after_length, :after_coin_id)
+ORDER BY rank, length(coin_id), coin_id
+LIMIT :limit
+'''
+
+INSERT_TRANSACTION = '''
+INSERT INTO transactions (portfolio_id, coin_id, amount, price_per_coin, date, transaction_type)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Normalized portfolio history: one row per refresh with its precomputed total,
+# the per-coin amounts and prices behind it, and hourly/daily/weekly rollups.
+CREATE_HISTORY_SNAPSHOTS_TABLE = '''
+CREATE TABLE IF NOT EXISTS history_snapshots (
+    portfolio_id INTEGER,
+    ts TEXT,
+    total_value REAL,
+    PRIMARY KEY (portfolio_id, ts)
+) WITHOUT ROWID
+'''
+
+CREATE_HISTORY_POSITIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS history_positions (
+    portfolio_id INTEGER,
+    ts TEXT,
+    coin_id TEXT,
+    amount REAL,
+    price REAL,
+    PRIMARY KEY (portfolio_id, ts, coin_id)
+) WITHOUT ROWID
+'''
+
+CREATE_HISTORY_ROLLUPS_TABLE = '''
+CREATE TABLE IF NOT EXISTS history_rollups (
+    portfolio_id INTEGER,
+    resolution TEXT,
+    bucket TEXT,
+    ts TEXT,
+    open_value REAL,
+    high_value REAL,
+    low_value REAL,
+    close_value REAL,
+    samples INTEGER,
+    PRIMARY KEY (portfolio_id, resolution, bucket)
+) WITHOUT ROWID
+'''
+
+INSERT_HISTORY_SNAPSHOT = '''
+INSERT OR REPLACE INTO history_snapshots (portfolio_id, ts, total_value) VALUES (?, ?, ?)
+'''
+
+INSERT_HISTORY_POSITION = '''
+INSERT OR REPLACE INTO history_positions (portfolio_id, ts, coin_id, amount, price) VALUES (?, ?, ?, ?, ?)
+'''
+
+# Snapshots arrive in time order, so the newest sample is always the bucket's close.
+UPSERT_HISTORY_ROLLUP = '''
+INSERT INTO history_rollups (portfolio_id, resolution, bucket, ts, open_value, high_value, low_value,
+                             close_value, samples)
+VALUES (:portfolio_id, :resolution, :bucket, :ts, :value, :value, :value, :value, 1)
+ON CONFLICT (portfolio_id, resolution, bucket) DO UPDATE SET
+    ts = excluded.ts,
+    high_value = max(high_value, excluded.high_value),
+    low_value = min(low_value, excluded.low_value),
+    close_value = excluded.close_value,
+    samples = samples + 1
+'''
+
+SELECT_HISTORY_SNAPSHOTS = '''
+SELECT ts, total_value FROM history_snapshots
+WHERE portfolio_id = :portfolio_id AND ts >= :start AND ts <= :end AND (:after IS NULL OR ts > :after)
+ORDER BY ts
+LIMIT :limit
+'''
+
+SELECT_HISTORY_ROLLUPS = '''
+SELECT bucket, close_value FROM history_rollups
+WHERE portfolio_id = :portfolio_id AND resolution = :resolution AND bucket >= :start AND bucket <= :end
+  AND (:after IS NULL OR bucket > :after)
+ORDER BY bucket
+LIMIT :limit
+'''
+
+SELECT_FIRST_HISTORY_TS = '''
+SELECT (SELECT min(bucket) FROM history_rollups WHERE portfolio_id = :portfolio_id AND resolution = 'week'),
+       (SELECT min(ts) FROM history_snapshots WHERE portfolio_id = :portfolio_id)
+'''
+
+# Cached /coins/{id}/market_chart/range prices, one row per coin holding the whole series as
+# packed little-endian int64 timestamps and float64 prices, plus the time range fetched so far.
+CREATE_PRICE_SERIES_TABLE = '''
+CREATE TABLE IF NOT EXISTS price_series (
+    coin_id TEXT,
+    vs_currency TEXT,
+    start_ts INTEGER,
+    end_ts INTEGER,
+    timestamps BLOB,
+    prices BLOB,
+    PRIMARY KEY (coin_id, vs_currency)
+)
+'''
+
+UPSERT_PRICE_SERIES = '''
+INSERT OR REPLACE INTO price_series (coin_id, vs_currency, start_ts, end_ts, timestamps, prices)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Every coin held by a live portfolio, with the age of its price in that portfolio's currency.
+# Prices only refreshed through /simple/price count as stale, so their change windows get refetched.
+SELECT_ACTIVE_POSITION_PRICES = '''
+SELECT p.portfolio_id, lower(pf.currency), p.coin_id, s.changes_updated
+FROM positions AS p
+JOIN portfolios AS pf ON pf.id = p.portfolio_id AND pf.deleted = 0
+LEFT JOIN price_snapshots AS s ON s.coin_id = p.coin_id AND s.vs_currency = lower(pf.currency)
+WHERE p.amount != 0
+'''
+
+# Lot accounting state per (portfolio, coin, method) after the first `seq` transactions in
+# (date, id) order. Open lots are packed float64 (amount, price) pairs, oldest first.
+CREATE_LEDGER_CHECKPOINTS_TABLE = '''
+CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+    portfolio_id INTEGER,
+    coin_id TEXT,
+    method TEXT,
+    seq INTEGER,
+    last_date TEXT,
+    last_id INTEGER,
+    amount REAL,
+    cost_basis REAL,
+    realized_pnl REAL,
+    lots BLOB,
+    PRIMARY KEY (portfolio_id, coin_id, method, seq)
+)
+'''
+
+# Replaces idx_transactions_portfolio_coin: same prefix, plus the ledger's replay order
+CREATE_TRANSACTIONS_LEDGER_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_transactions_portfolio_coin_date ON transactions (portfolio_id, coin_id, date, id)
+'''
+
+SELECT_LATEST_LEDGER_CHECKPOINT = '''
+SELECT seq, last_date, last_id, amount, cost_basis, realized_pnl FROM ledger_checkpoints
+WHERE portfolio_id = :portfolio_id AND coin_id = :coin_id AND method = :method
+ORDER BY seq DESC
+LIMIT 1
+'''
+
+SELECT_LEDGER_CHECKPOINT_LOTS = '''
+SELECT lots FROM ledger_checkpoints
+WHERE portfolio_id = :portfolio_id AND coin_id = :coin_id AND method = :method AND seq = :seq
+'''
+
+INSERT_LEDGER_CHECKPOINT = '''
+INSERT OR REPLACE INTO ledger_checkpoints
+    (portfolio_id, coin_id, method, seq, last_date, last_id, amount, cost_basis, realized_pnl, lots)
+VALUES (:portfolio_id, :coin_id, :method, :seq, :last_date, :last_id, :amount, :cost_basis, :realized_pnl, :lots)
+'''
+
+# The latest checkpoint moves forward on every replay; only the periodic ones are kept behind it
+DELETE_INTERIM_LEDGER_CHECKPOINTS = '''
+DELETE FROM ledger_checkpoints
+WHERE portfolio_id = :portfolio_id AND coin_id = :coin_id AND method = :method AND seq % :interval != 0
+'''
+
+# Drops every checkpoint that includes transactions dated on or after :since
+INVALIDATE_LEDGER_CHECKPOINTS = '''
+DELETE FROM ledger_checkpoints
+WHERE portfolio_id = :portfolio_id AND coin_id = :coin_id AND last_date >= :since
+'''
+
+DELETE_LEDGER_CHECKPOINTS = '''
+DELETE FROM ledger_checkpoints WHERE :portfolio_id IS NULL OR portfolio_id = :portfolio_id
+'''
+
+SELECT_LEDGER_TRANSACTIONS = '''
+SELECT id, amount, price_per_coin, date, transaction_type FROM transactions
+WHERE portfolio_id = :portfolio_id AND coin_id = :coin_id
+  AND (date, id) > (coalesce(:last_date, ''), coalesce(:last_id, 0))
+ORDER BY date, id
+'''
+
+# positions has a row for every coin a portfolio ever traded, so this avoids scanning transactions
+SELECT_LEDGER_COINS = '''
+SELECT coin_id FROM positions WHERE portfolio_id = ? AND transaction_count > 0
+'''
+
+# Conditional request headers and content hash of the last download, per synced endpoint.
+CREATE_SYNC_STATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    synced_at TEXT
+)
+'''
+
+SELECT_SYNC_STATE = '''
+SELECT etag, last_modified, content_hash FROM sync_state WHERE name = ?
+'''
+
+UPSERT_SYNC_STATE = '''
+INSERT INTO sync_state (name, etag, last_modified, content_hash, synced_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET
+    etag = excluded.etag,
+    last_modified = excluded.last_modified,
+    content_hash = excluded.content_hash,
+    synced_at = excluded.synced_at
+'''
+
+# positions.total_cost held the net cash flow rather than a cost basis
+RENAME_POSITIONS_TOTAL_COST = '''
+ALTER TABLE positions RENAME COLUMN total_cost TO net_invested
+'''
+
+ADD_CRYPTOLOOKUP_DELISTED_AT = '''
+ALTER TABLE crypto_lookup ADD COLUMN delisted_at TEXT
+'''
+
+# The search index only holds listed coins
+CREATE_CRYPTOLOOKUP_LISTING_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS crypto_lookup_fts_delist AFTER UPDATE OF delisted_at ON crypto_lookup
+    WHEN old.delisted_at IS NULL AND new.delisted_at IS NOT NULL BEGIN
+        DELETE FROM crypto_lookup_fts WHERE coin_id = old.coin_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS crypto_lookup_fts_relist AFTER UPDATE OF delisted_at ON crypto_lookup
+    WHEN old.delisted_at IS NOT NULL AND new.delisted_at IS NULL BEGIN
+        INSERT INTO crypto_lookup_fts (coin_id, symbol, name) VALUES (new.coin_id, new.symbol, new.name);
+    END
+    ''',
+]
+
+# Staging table for one /coins/list download; compared against crypto_lookup once it is complete.
+CREATE_SEEN_COINS_TABLE = '''
+CREATE TEMP TABLE IF NOT EXISTS seen_coins (
+    coin_id TEXT PRIMARY KEY,
+    symbol TEXT,
+    name TEXT
+) WITHOUT ROWID
+'''
+
+INSERT_SEEN_COIN = '''
+INSERT OR REPLACE INTO temp.seen_coins (coin_id, symbol, name) VALUES (?, ?, ?)
+'''
+
+CLEAR_SEEN_COINS = '''
+DELETE FROM temp.seen_coins
+'''
+
+COUNT_NEW_COINS = '''
+SELECT count(*) FROM temp.seen_coins AS s
+WHERE NOT EXISTS (SELECT 1 FROM crypto_lookup AS c WHERE c.coin_id = s.coin_id)
+'''
+
+COUNT_CHANGED_COINS = '''
+SELECT count(*) FROM temp.seen_coins AS s JOIN crypto_lookup AS c ON c.coin_id = s.coin_id
+WHERE c.symbol IS NOT s.symbol OR c.name IS NOT s.name OR c.delisted_at IS NOT NULL
+'''
+
+# Only rows that actually changed are rewritten, so unchanged coins cost no writes or trigger work.
+# (WHERE true keeps SQLite from reading ON CONFLICT as a join constraint.)
+UPSERT_COINS_FROM_SEEN = '''
+INSERT INTO crypto_lookup (coin_id, symbol, name)
+SELECT coin_id, symbol, name FROM temp.seen_coins WHERE true
+ON CONFLICT (coin_id) DO UPDATE SET
+    symbol = excluded.symbol,
+    name = excluded.name,
+    delisted_at = NULL
+WHERE symbol IS NOT excluded.symbol OR name IS NOT excluded.name OR delisted_at IS NOT NULL
+'''
+
+COUNT_LISTED_COINS = '''
+SELECT count(*) FROM crypto_lookup WHERE delisted_at IS NULL
+'''
+
+COUNT_UNSEEN_COINS = '''
+SELECT count(*) FROM crypto_lookup AS c
+WHERE c.delisted_at IS NULL AND NOT EXISTS (SELECT 1 FROM temp.seen_coins AS s WHERE s.coin_id = c.coin_id)
+'''
+
+DELIST_UNSEEN_COINS = '''
+UPDATE crypto_lookup SET delisted_at = ?
+WHERE delisted_at IS NULL AND NOT EXISTS (SELECT 1 FROM temp.seen_coins AS s WHERE s.coin_id = crypto_lookup.coin_id)
+'''
+
+# Coin ids on other price providers, keyed by the CoinGecko id used everywhere else.
+# provider_coin_id is NULL when the coin could not be matched as of checked_at.
+CREATE_PROVIDER_COIN_IDS_TABLE = '''
+CREATE TABLE IF NOT EXISTS provider_coin_ids (
+    provider TEXT NOT NULL,
+    coin_id TEXT NOT NULL,
+    provider_coin_id TEXT,
+    checked_at TEXT NOT NULL,
+    PRIMARY KEY (provider, coin_id)
+) WITHOUT ROWID
+'''
+
+SELECT_PROVIDER_COIN_IDS = '''
+SELECT coin_id, provider_coin_id, checked_at FROM provider_coin_ids WHERE provider = ?
+'''
+
+SELECT_COIN_LISTING = '''
+SELECT symbol, name FROM crypto_lookup WHERE coin_id = ?
+'''
+
+UPSERT_PROVIDER_COIN_ID = '''
+INSERT INTO provider_coin_ids (provider, coin_id, provider_coin_id, checked_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (provider, coin_id) DO UPDATE SET
+    provider_coin_id = excluded.provider_coin_id,
+    checked_at = excluded.checked_at
+'''
@@ -0,0 +1,232 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from database import connect
+from history import DATE_FORMAT, query_history
+from prices import portfolio_value
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+TEMPLATE_PATH = 'portfolio_template.html'
+# Only these directories are served as files, so the database next to them never is
+STATIC_DIRECTORIES = ('/css/', '/js/', '/fonts/')
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Responses smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
+PORTFOLIO_ROUTE = re.compile(r'^/api/portfolios/(\d+)/(value|history|pnl)$')
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """
+    Reader connections shared by the request threads; WAL lets them read while a refresh writes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._idle = queue.SimpleQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.path, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            # Never hand a connection back in the middle of a transaction
+            conn.rollback()
+            self._idle.put(conn)
+
+
+class PortfolioRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the portfolio page, its static assets and the JSON API:
+
+        GET /api/portfolios
+        GET /api/value?currency=
+        GET /api/portfolios/<id>/value?currency=
+        GET /api/portfolios/<id>/history?start=&end=&resolution=&after=&limit=
+        GET /api/portfolios/<id>/pnl?method=
+
+    JSON responses carry an ETag so polling clients get 304 Not Modified when nothing changed,
+    and are gzipped when the client accepts it.
+    """
+
+    server_version = 'PortfolioServer/1.0'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path in ('/', '/index.html'):
+            self.send_body(self.server.template, 'text/html; charset=utf-8')
+        elif url.path.startswith('/api/'):
+            try:
+                payload = self.route_api(url.path, parse_qs(url.query))
+            except ApiError as error:
+                self.send_body(json.dumps({'error': str(error)}).encode(), 'application/json', error.status)
+            else:
+                self.send_body(json.dumps(payload, separators=(',', ':')).encode(), 'application/json')
+        elif self.is_static(url.path):
+            super().do_GET()
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def do_HEAD(self):
+        if self.is_static(urlsplit(self.path).path):
+            super().do_HEAD()
+        else:
+            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
+
+    @staticmethod
+    def is_static(path):
+        # Normalize first so /css/../portfolio.db cannot escape the asset directories
+        return posixpath.normpath(unquote(path)).startswith(STATIC_DIRECTORIES)
+
+    def route_api(self, path, query):
+        with self.server.pool.connection() as conn:
+            if path == '/api/portfolios':
+                rows = conn.execute('''SELECT id, name, currency FROM portfolios WHERE deleted = 0 ORDER BY id''')
+                return [{'id': portfolio_id, 'name': name, 'currency': currency}
+                        for portfolio_id, name, currency in rows]
+
+            currency = (query.get('currency', [''])[0] or '').lower() or None
+            if path == '/api/value':
+                # All live portfolios combined
+                return portfolio_value(conn.cursor(), currency or 'usd')
+
+            match = PORTFOLIO_ROUTE.match(path)
+            if not match:
+                raise ApiError(HTTPStatus.NOT_FOUND, f"Unknown endpoint {path}")
+            portfolio = self.load_portfolio(conn, int(match.group(1)))
+            if match.group(2) == 'value':
+                return dict(portfolio.get_portfolio_value(currency),
+                            portfolio={'id': portfolio.portfolio_id, 'name': portfolio.name,
+                                       'currency': portfolio.currency})
+            if match.group(2) == 'pnl':
+                try:
+                    # Pooled connections only read; the CLI pnl command saves checkpoints
+                    return portfolio.get_profit_and_loss(query.get('method', [None])[0], save_checkpoints=False)
+                except ValueError as error:
+                    raise ApiError(HTTPStatus.BAD_REQUEST, str(error))
+            return self.history_page(conn, portfolio.portfolio_id, query)
+
+    @staticmethod
+    def load_portfolio(conn, portfolio_id):
+        # The manager is only used for its read queries, so it is cheap to build per request
+        from portfolio import CoinGeckoPortfolioManager
+        row = conn.execute('''SELECT name, currency FROM portfolios WHERE id = ? AND deleted = 0''',
+                           (portfolio_id,)).fetchone()
+        if row is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"Portfolio {portfolio_id} not found")
+        return CoinGeckoPortfolioManager(portfolio_id, row[0], row[1], conn=conn)
+
+    @staticmethod
+    def history_page(conn, portfolio_id, query):
+        def param(name):
+            values = query.get(name)
+            return values[0] if values and values[0] else None
+
+        try:
+            limit = int(param('limit') or DEFAULT_PAGE_SIZE)
+        except ValueError:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "limit must be an integer")
+        if limit < 1:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "limit must be at least 1")
+        limit = min(MAX_PAGE_SIZE, limit)
+        try:
+            after = param('after')
+            if after is not None:
+                datetime.strptime(after, DATE_FORMAT)
+            resolution, points = query_history(conn.cursor(), portfolio_id, param('start'), param('end'),
+                                               param('resolution'), after, limit)
+        except ValueError as error:
+            raise ApiError(HTTPStatus.BAD_REQUEST, str(error))
+        return {
+            'resolution': resolution,
+            'data': [{'last_updated': ts, 'total_value': total_value} for ts, total_value in points],
+            # Pass back as `after` (with the same resolution) to get the next page
+            'next': points[-1][0] if points and len(points) == limit else None,
+        }
+
+    def send_body(self, body, content_type, status=HTTPStatus.OK):
+        digest = hashlib.sha1(body).hexdigest()
+        encoding = 'gzip' if len(body) >= GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', '') else None
+        # Each encoding is a different representation, so it gets its own tag
+        etag = f'"{digest}-gzip"' if encoding else f'"{digest}"'
+        if status == HTTPStatus.OK and digest in self.headers.get('If-None-Match', ''):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        if encoding:
+            body = gzip.compress(body, compresslevel=6)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        # Always revalidate; the ETag makes that a cheap 304
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class PortfolioServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host=None, port=None, db_path=None, verbose=False):
+        host = host or os.getenv("PORTFOLIO_WEB_HOST") or DEFAULT_HOST
+        port = int(os.getenv("PORTFOLIO_WEB_PORT", DEFAULT_PORT)) if port is None else port
+        self.root = os.path.dirname(os.path.abspath(__file__))
+        # The page itself is static; all data is fetched from the API
+        with open(os.path.join(self.root, TEMPLATE_PATH), 'rb') as template_file:
+            self.template = template_file.read()
+        self.pool = ConnectionPool(db_path)
+        self.verbose = verbose
+        super().__init__((host, port), self.handler)
+
+    def handler(self, *args, **kwargs):
+        return PortfolioRequestHandler(*args, directory=self.root, **kwargs)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def portfolio_url(self, portfolio_id):
+        return f"{self.url}?portfolio={portfolio_id}"
+
+    def start(self):
+        """
+        Serve from a daemon thread and return immediately.
+        """
+        thread = threading.Thread(target=self.serve_forever, name='portfolio-web', daemon=True)
+        thread.start()
+        return thread